@@ -1,7 +1,12 @@
 # backend/app/main.py
+import os
+import asyncio
 from fastapi import FastAPI, responses
 from fastapi.middleware.cors import CORSMiddleware
 from .routers import specs
+from .utils.metrics import registry
+from .utils.rate_limiter import limiter
+from .pipeline import job_queue, job_workers, spec_store, output_sizes
 
 app = FastAPI(
     title="API Copilot — Spec Generator",
@@ -53,7 +58,10 @@ def root():
                 <li>Interactive API documentation: <a href="/docs" target="_blank">Swagger UI (/docs)</a></li>
                 <li>Alternative docs: <a href="/redoc" target="_blank">ReDoc (/redoc)</a></li>
                 <li>Generate specs: <code>POST /specs/generate</code></li>
+                <li>Stream stages as they finish (SSE): <code>POST /specs/generate/stream</code></li>
+                <li>Background jobs for long generations: <code>POST /specs/jobs</code>, then <code>GET /specs/jobs/{id}</code></li>
                 <li>Refine specs: <code>POST /specs/refine</code></li>
+                <li>Prometheus metrics: <code>GET /metrics</code></li>
             </ul>
             <p><strong>Frontend</strong> is hosted separately on Vercel and connects to this API.</p>
             <hr>
@@ -67,6 +75,11 @@ def root():
 def health():
     return {"status": "ok", "service": "API Copilot"}
 
+# Prometheus scrape endpoint: stage latencies, LLM calls, tokens, retries and failure reasons
+@app.get("/metrics", response_class=responses.PlainTextResponse)
+def prometheus_metrics():
+    return responses.PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 # Startup logging — matches Socrates style
 @app.on_event("startup")
 async def startup_event():
@@ -76,5 +89,25 @@ async def startup_event():
     print("• CORS enabled (all origins)")
     print("• Router mounted: /specs/*")
     print("• Swagger UI available at /docs")
-    print("• Versioning logs saved in backend/app/logs/")
+    print("• Versioned specs stored in backend/app/logs/specs.sqlite3")
+    print(f"• Job workers: {job_workers.concurrency} (queue in backend/app/logs/jobs.sqlite3)")
+    if limiter.backend.blocking:
+        print("• Rate limits shared by all workers on this host (RATE_LIMIT_BACKEND=sqlite)")
+    else:
+        print("• Rate limits kept per process; set RATE_LIMIT_BACKEND=sqlite to share them between workers")
     print("="*70 + "\n")
+    purged = await asyncio.to_thread(job_queue.purge, float(os.getenv("JOB_RETENTION_DAYS", "7")) * 86400)
+    if purged:
+        print(f"Purged {purged} finished jobs")
+    purged = await asyncio.to_thread(spec_store.purge_checkpoints,
+                                     float(os.getenv("CHECKPOINT_RETENTION_DAYS", "7")) * 86400)
+    if purged:
+        print(f"Purged {purged} stale stage checkpoints")
+    # Seed the learned max_tokens from saved specs off the event loop, before the first request needs them
+    await asyncio.to_thread(output_sizes.load)
+    job_workers.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Running jobs go straight back to the queue for the next process to pick up
+    await job_workers.stop()
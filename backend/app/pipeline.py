@@ -1,15 +1,33 @@
 # backend/app/pipeline.py
 import os
+import copy
+import contextlib
 import json
 import uuid
-from jsonschema import validate, ValidationError
+import time
+import asyncio
 from datetime import datetime
+from collections import Counter
 from dotenv import load_dotenv
-from groq import Groq
+from .utils.llm_cache import llm_cache, make_cache_key
+from .utils.json_patch import apply_patch, JsonPatchError
+from .utils.json_repair import repair_json, repair_stats
+from .utils.output_sizes import OutputSizeTracker
+from .utils.spec_store import SpecStore, SpecNotFound, VersionConflict
+from .utils.scheduler import FairLLMScheduler, llm_owner
+from .utils.llm_backends import build_backend
+from .utils.job_queue import JobQueue, JobWorkerPool, JobFailed
+from .utils.singleflight import SingleFlight, flight_key, normalize_text
+from .utils.hedging import Hedger
+from .utils.model_router import ModelRouter
+from .utils.admission import AdmissionController
+from .utils.prompt_budget import PromptSection, fit_prompt, clip_text, summarize_text
+from .utils.prompt_registry import FileRegistry, Template
+from .utils.spec_validation import SpecValidator, SchemaViolation
+from .utils import metrics
 
 # Load API key
 load_dotenv()
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
 # === PATHS ===
 BASE_DIR = os.path.dirname(__file__)  # backend/app/
@@ -19,21 +37,34 @@ PROMPTS_DIR = os.path.join(BASE_DIR, "prompts")
 PROMPTS = {
     "features": os.path.join(PROMPTS_DIR, "v1_features.md"),
     "stories":  os.path.join(PROMPTS_DIR, "v1_stories.md"),
-    "api_db":   os.path.join(PROMPTS_DIR, "v1_api_db.md")
+    "api":      os.path.join(PROMPTS_DIR, "v1_api.md"),
+    "db":       os.path.join(PROMPTS_DIR, "v1_db.md"),
+    "open_questions": os.path.join(PROMPTS_DIR, "v1_open_questions.md"),
+    "refine":   os.path.join(PROMPTS_DIR, "v1_refine.md"),
+    "refine_patch": os.path.join(PROMPTS_DIR, "v1_refine_patch.md")
 }
 
-# Output directory: backend/app/logs/<base_trace_id>/vX.json
+# Versioned specs live in a SQLite store: backend/app/logs/specs.sqlite3.
+# Legacy backend/app/logs/trace_*/vX.json directories are imported on first use.
 OUTPUT_DIR = os.path.join(BASE_DIR, "logs")
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+spec_store = SpecStore(os.getenv("SPEC_STORE_PATH", os.path.join(OUTPUT_DIR, "specs.sqlite3")), legacy_dir=OUTPUT_DIR)
 
-# === Load schema and prompts ===
-with open(SCHEMA_PATH, "r", encoding="utf-8") as f:
-    FULL_SCHEMA = json.load(f)
+# Per-stage max_tokens learned from past outputs (seeded from the saved specs)
+output_sizes = OutputSizeTracker(spec_store.iter_specs)
 
-prompt_templates = {}
-for key, path in PROMPTS.items():
-    with open(path, "r", encoding="utf-8") as f:
-        prompt_templates[key] = f.read()
+# === Schema and prompts: loaded on first use, reloaded when the files change (see utils/prompt_registry.py) ===
+RELOAD_SECONDS = float(os.getenv("PROMPT_RELOAD_SECONDS", "2"))  # negative: never look for changes
+prompts = FileRegistry(PROMPTS, Template, check_interval=RELOAD_SECONDS)
+schemas = FileRegistry({"output": SCHEMA_PATH}, json.loads, check_interval=RELOAD_SECONDS)
+# Compiled once per schema version; each stage's output is validated against its slice of the schema
+spec_validator = SpecValidator(lambda: schemas.get_versioned("output"))
+
+# LLM provider: Groq by default, LLM_BACKEND=mock serves canned specs offline (see utils/llm_backends.py)
+def schema_valid_specs():
+    # Saved specs the mock may replay; older ones that no longer match the schema are skipped
+    return (spec for spec in spec_store.iter_specs() if final_validate(spec)[0])
+
+llm_backend = build_backend(os.path.join(BASE_DIR, "schemas", "mock_output.json"), spec_source=schema_valid_specs)
 
 # === Helper: clean JSON output ===
 def clean_json_output(raw: str) -> str:
@@ -47,250 +78,760 @@ def clean_json_output(raw: str) -> str:
     return raw.strip()
 
 # === LLM call ===
-def llm_generate(prompt: str, temperature=0.0, max_tokens=2500):
-    completion = client.chat.completions.create(
-        model="llama-3.3-70b-versatile",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=temperature,
-        max_tokens=max_tokens,
-        top_p=1,
-        stream=False
-    )
-    return completion.choices[0].message.content.strip()
-
-# === Versioning helper ===
-def get_versioned_paths(base_trace_id: str):
-    trace_dir = os.path.join(OUTPUT_DIR, base_trace_id)
-    os.makedirs(trace_dir, exist_ok=True)
-
-    existing = [f for f in os.listdir(trace_dir) if f.startswith("v") and f.endswith(".json")]
-    versions = []
-    for f in existing:
+MODEL = "llama-3.3-70b-versatile"
+SMALL_MODEL = "llama-3.1-8b-instant"
+
+# Candidate models per stage, cheapest first (see utils/model_router.py). Features and stories are
+# simple enough for the small model; a reply that fails validation is retried on the next stronger one.
+# Override with LLM_ROUTES='{"stage": ["model", ...]}' ('{}' sends everything to MODEL).
+DEFAULT_ROUTES = {"features": [SMALL_MODEL, MODEL], "stories": [SMALL_MODEL, MODEL]}
+model_router = ModelRouter(
+    routes=json.loads(os.getenv("LLM_ROUTES") or json.dumps(DEFAULT_ROUTES)),
+    default=MODEL,
+    # Dollars per million tokens, blended input/output
+    prices=json.loads(os.getenv("LLM_MODEL_PRICES") or json.dumps({SMALL_MODEL: 0.06, MODEL: 0.65})),
+    latency_cost=float(os.getenv("LLM_ROUTER_LATENCY_COST", "0.001")),
+    explore=float(os.getenv("LLM_ROUTER_EXPLORE", "0.05")),
+    # Offline runs start every stage on its first candidate, so replays call the models the recording did
+    pinned=os.getenv("LLM_ROUTER_PINNED", "1" if os.getenv("LLM_BACKEND") == "mock" or os.getenv("LLM_CASSETTE")
+                     else "0") == "1"
+)
+
+# Global cap on concurrent provider calls, shared fairly between pipelines (see utils/scheduler.py)
+llm_scheduler = FairLLMScheduler(max_in_flight=int(os.getenv("LLM_MAX_IN_FLIGHT", "8")))
+metrics.registry.gauge("spec_llm_in_flight", "LLM calls currently running", lambda: llm_scheduler.in_flight)
+metrics.registry.gauge("spec_llm_queued", "LLM calls waiting for a scheduler slot", lambda: llm_scheduler.queued)
+
+# Admission control for the interactive routes (see utils/admission.py): a request whose estimated
+# wait for LLM capacity exceeds its lane's deadline gets a fast 503 instead of slowing everyone down.
+# Refinements get the longer deadline, so generations are shed first.
+admission = AdmissionController(llm_scheduler, lanes={
+    "generation": {"max_wait": float(os.getenv("ADMISSION_GENERATE_MAX_WAIT", "20")),
+                   "max_in_flight": int(os.getenv("ADMISSION_GENERATE_MAX_IN_FLIGHT", "32")), "calls": 5},
+    "refinement": {"max_wait": float(os.getenv("ADMISSION_REFINE_MAX_WAIT", "40")),
+                   "max_in_flight": int(os.getenv("ADMISSION_REFINE_MAX_IN_FLIGHT", "32")), "calls": 1},
+})
+metrics.registry.gauge("spec_admission_in_flight", "Admitted requests in progress, by lane",
+                       lambda: {(("lane", lane),): n for lane, n in admission.in_flight.items()})
+metrics.registry.gauge("spec_admission_estimated_wait_seconds", "Estimated wait for LLM capacity",
+                       admission.estimate_wait)
+
+# Hedged requests for the slow tail of each stage (see utils/hedging.py). Off unless LLM_HEDGE_STAGES
+# lists stages (or "*"): every hedge is a paid duplicate call, capped at LLM_HEDGE_MAX_EXTRA of the traffic.
+hedger = Hedger(
+    stages=[s.strip() for s in os.getenv("LLM_HEDGE_STAGES", "").split(",") if s.strip()],
+    percentile=float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95")),
+    max_extra=float(os.getenv("LLM_HEDGE_MAX_EXTRA", "0.1")),
+    min_samples=int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+)
+metrics.registry.gauge("spec_json_repair", "Local JSON repair counters (utils/json_repair.py)",
+                       lambda: {(("kind", k),): v for k, v in repair_stats.items()})
+CONTINUE_INSTRUCTION = (
+    "Your previous reply was cut off by the length limit. Continue EXACTLY where it stopped, "
+    "without repeating anything and without code fences or commentary."
+)
+
+async def llm_generate(prompt: str, temperature=0.0, max_tokens=2500, use_cache=True, on_token=None,
+                       continue_from: str = None, stage: str = None, model: str = MODEL):
+    # Returns (content, finish_reason). finish_reason == "length" means max_tokens cut the reply short.
+    # Identical (model, prompt, temperature) calls are served from the cache, unless the cached reply
+    # was cut short under a different max_tokens.
+    # use_cache=False skips the lookup but still refreshes the stored response.
+    # on_token: optional async callback; when set the completion is streamed and each delta forwarded.
+    # continue_from: a truncated earlier reply to this prompt that the model should carry on from.
+    # stage: which pipeline stage is asking (passed through to the backend).
+    # model: chosen by model_router for the stage; part of the cache key.
+    messages = [{"role": "user", "content": prompt}]
+    cache_prompt = prompt
+    if continue_from is not None:
+        messages += [{"role": "assistant", "content": continue_from},
+                     {"role": "user", "content": CONTINUE_INSTRUCTION}]
+        cache_prompt = f"{prompt}\x00{continue_from}"
+
+    key = make_cache_key(model, cache_prompt, temperature)
+    cached = await asyncio.to_thread(llm_cache.get, key) if use_cache else None
+    if cached is not None:
         try:
-            v_num = int(f[1:f.index(".json")])
-            versions.append(v_num)
-        except:
-            pass
-    next_version = max(versions, default=0) + 1
-
-    version_file = os.path.join(trace_dir, f"v{next_version}.json")
-    latest_file = os.path.join(trace_dir, "latest.json")
-    history_file = os.path.join(trace_dir, "history.json")
-
-    return trace_dir, version_file, latest_file, history_file, next_version
-
-# === Step 1: Extract features (unchanged) ===
-def extract_features(requirements_text: str, retries=2):
-    template = prompt_templates["features"]
-    prompt = template.replace("{requirements_text}", requirements_text.strip())
-
-    for attempt in range(retries + 1):
-        raw = llm_generate(prompt)
-        cleaned = clean_json_output(raw)
+            entry = json.loads(cached)
+        except ValueError:
+            entry = None
+        if not isinstance(entry, dict) or "finish_reason" not in entry:
+            entry = {"content": cached, "finish_reason": "stop"}  # entries cached before finish_reason was stored
+        # Cut short under another budget: this one may get further, so call again
+        if entry["finish_reason"] != "length" or entry.get("max_tokens") == max_tokens:
+            if on_token is not None:
+                await on_token(entry["content"])
+            metrics.record_llm_call(stage, "cached")
+            return entry["content"], entry["finish_reason"]
+
+    async with llm_scheduler.slot(llm_owner.get()):
+        start = time.perf_counter()
         try:
-            data = json.loads(cleaned)
-            if "modules" in data and "features_by_module" in data:
-                return data, True
-        except json.JSONDecodeError:
-            pass
-        if attempt < retries:
-            prompt = f"INVALID JSON. Return only valid JSON.\nPrevious:\n{cleaned}\n\nTry again:\n{template.replace('{requirements_text}', requirements_text.strip())}"
-    return cleaned, False
-
-# === Step 2: Generate user stories (now receives original requirements) ===
-def generate_stories(features_data: dict, original_requirements: str, retries=2):
-    template = prompt_templates["stories"]
-    input_json = json.dumps(features_data, indent=2)
-    prompt = template.replace("{features_json}", input_json) \
-                     .replace("{original_requirements}", original_requirements.strip())
+            content, finish_reason, usage = await llm_backend.complete(
+                model, messages, temperature, max_tokens, on_token=on_token, stage=stage
+            )
+        except Exception:
+            metrics.record_llm_call(stage, "error", time.perf_counter() - start)
+            raise
+        elapsed = time.perf_counter() - start
+        metrics.record_llm_call(stage, "ok", elapsed, usage)
+        admission.observe_call(elapsed)
+        if continue_from is None:
+            hedger.observe(stage, elapsed)
+            model_router.record_call(stage, model, elapsed, sum((usage or {}).get(k) or 0 for k in
+                                                                ("prompt_tokens", "completion_tokens")))
+
+    # Continuations keep their leading whitespace so they can be stitched verbatim
+    content = (content or "") if continue_from is not None else (content or "").strip()
+    entry = {"content": content, "finish_reason": finish_reason, "max_tokens": max_tokens}
+    await asyncio.to_thread(llm_cache.set, key, json.dumps(entry))
+    return content, finish_reason
+
+async def forget_cached(prompt: str, temperature=0.0, model: str = MODEL):
+    # Called when a response fails validation so the bad output is never replayed
+    await asyncio.to_thread(llm_cache.delete, make_cache_key(model, prompt, temperature))
+
+def stitch_continuation(partial: str, continuation: str) -> str:
+    continuation = continuation.lstrip("\n")
+    if continuation.startswith("```"):
+        continuation = clean_json_output(continuation)
+    # Drop any overlap where the model repeated the end of what it already sent
+    for size in range(min(len(partial), len(continuation), 200), 10, -1):
+        if partial.endswith(continuation[:size]):
+            return partial + continuation[size:]
+    return partial + continuation
+
+# === Shared generate → parse → check → retry loop used by every stage ===
+MAX_CONTINUATIONS = int(os.getenv("LLM_MAX_CONTINUATIONS", "2"))
+
+# Context is serialized compactly and trimmed, least valuable first, to stay under the budget
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+RETRY_PREVIOUS_TOKENS = int(os.getenv("PROMPT_RETRY_PREVIOUS_TOKENS", "800"))
+
+def build_prompt(template_name: str, sections: list, stage: str) -> str:
+    template, version = prompts.get_versioned(template_name)
+    request = metrics.current_request.get()
+    if request is not None:
+        request.prompt_versions[template_name] = version  # saved with the trace
+    prompt, tokens, reductions = fit_prompt(template, sections, PROMPT_TOKEN_BUDGET)
+    metrics.prompt_tokens.observe(tokens, stage=stage)
+    for step in reductions:
+        metrics.prompt_reductions.inc(stage=stage, step=step)
+    if reductions:
+        print(f"Prompt for {stage} trimmed to ~{tokens} tokens: {', '.join(reductions)}")
+    return prompt
+
+def without_story_rationale(spec: dict, target_tokens: int) -> dict:
+    # The "so_that" clause rarely changes which endpoints or tables are needed
+    stories = [{k: v for k, v in s.items() if k != "so_that"} if isinstance(s, dict) else s
+               for s in spec.get("user_stories") or []]
+    return dict(spec, user_stories=stories)
+
+def without_stories(spec: dict, target_tokens: int) -> dict:
+    return {k: v for k, v in spec.items() if k != "user_stories"}
+
+async def generate_json(prompt: str, check, retry_hint: str, max_tokens=2500, retries=2,
+                        use_cache=True, on_token=None, stage: str = None, size_key: str = None):
+    # check(data) returns the stage result, or None when the parsed JSON is unusable.
+    # It may also raise ValueError; the message is fed back into the retry prompt. A SchemaViolation
+    # with a usable result is retried too, but that result is accepted if no retry does better.
+    # stage: when set, max_tokens adapts to the output sizes seen for that stage (or for size_key, when
+    # calls of one stage produce differently sized outputs, like story shards).
+    size_key = size_key or stage
+    if size_key is not None:
+        if not output_sizes.loaded:
+            await asyncio.to_thread(output_sizes.load)  # normally done at startup; never on the event loop
+        max_tokens = output_sizes.max_tokens(size_key, max_tokens)
+    base_prompt = prompt
+    model = model_router.pick(stage)
+
+    async def attempt_once(prompt, model):
+        # One completion (plus continuations), parsed and checked: (cleaned, result, error, reason, usable)
+        raw, finish_reason = await llm_generate(prompt, max_tokens=max_tokens, use_cache=use_cache,
+                                                on_token=on_token, stage=stage, model=model)
+
+        # Hit max_tokens: ask the model to resume from the partial JSON instead of starting over
+        continuations = 0
+        while finish_reason == "length" and continuations < MAX_CONTINUATIONS:
+            continuations += 1
+            print(f"Output truncated at {max_tokens} tokens, requesting continuation {continuations}")
+            more, finish_reason = await llm_generate(prompt, max_tokens=max_tokens, use_cache=use_cache,
+                                                     on_token=on_token, continue_from=raw, stage=stage, model=model)
+            raw = stitch_continuation(raw, more)
 
-    for attempt in range(retries + 1):
-        raw = llm_generate(prompt, max_tokens=1500)
         cleaned = clean_json_output(raw)
         try:
-            data = json.loads(cleaned)
-            if "user_stories" in data and isinstance(data["user_stories"], list):
-                return data["user_stories"], True
-        except json.JSONDecodeError:
-            pass
-        if attempt < retries:
-            retry_prompt = template.replace("{features_json}", input_json) \
-                                   .replace("{original_requirements}", original_requirements.strip())
-            prompt = f"Invalid output. Return ONLY JSON with 'user_stories' array.\nPrevious:\n{cleaned}\n\nRetry:\n{retry_prompt}"
-    return cleaned, False
-
-# === Step 3: Generate API + DB + open questions (now receives original requirements) ===
-def generate_api_db(full_data_so_far: dict, original_requirements: str, retries=2):
-    template = prompt_templates["api_db"]
-    input_json = json.dumps(full_data_so_far, indent=2)
-    prompt = template.replace("{input_json}", input_json) \
-                     .replace("{original_requirements}", original_requirements.strip())
-
+            # Salvage prose-wrapped, trailing-comma or truncated JSON locally before paying for a retry
+            data, repaired = repair_json(cleaned)
+            if repaired and finish_reason == "length":
+                # Cut back to what was complete, i.e. missing whatever did not fit: neither a success nor a fallback
+                return cleaned, None, f"Output still truncated after {MAX_CONTINUATIONS} continuations", "truncated", None
+            result = check(data)
+            if result is not None and repaired:
+                repair_stats["retries_avoided"] += 1
+            return cleaned, result, None, "missing_fields", None
+        except json.JSONDecodeError as e:
+            return cleaned, None, str(e), "invalid_json", None
+        except JsonPatchError as e:
+            return cleaned, None, str(e), "invalid_patch", None
+        except SchemaViolation as e:
+            return cleaned, None, str(e), "schema_invalid", e.usable
+        except ValueError as e:
+            return cleaned, None, str(e), "check_failed", None
+
+    fallback = None
     for attempt in range(retries + 1):
-        raw = llm_generate(prompt, max_tokens=3000)
-        cleaned = clean_json_output(raw)
-        try:
-            data = json.loads(cleaned)
-            required = ["api_endpoints", "db_schema", "open_questions"]
-            if all(k in data for k in required):
-                return data, True
-        except json.JSONDecodeError:
-            pass
+        if on_token is None:
+            # A hedge races a duplicate call once this one runs past the stage's usual latency;
+            # streamed stages are not hedged so clients never see two interleaved token streams
+            cleaned, result, error, reason, usable = await hedger.run(
+                stage, lambda: attempt_once(prompt, model), accept=lambda outcome: outcome[1] is not None,
+                allow=lambda: llm_scheduler.queued == 0
+            )
+        else:
+            cleaned, result, error, reason, usable = await attempt_once(prompt, model)
+        model_router.record_validity(stage, model, result is not None)
+        if result is not None:
+            if size_key is not None:
+                output_sizes.record(size_key, cleaned)
+            return result, True
+        if usable is not None:
+            fallback = usable
+        metrics.record_failure(stage, reason, error, retrying=attempt < retries)
+        await forget_cached(prompt, model=model)
         if attempt < retries:
-            retry_prompt = template.replace("{input_json}", input_json) \
-                                   .replace("{original_requirements}", original_requirements.strip())
-            prompt = f"Missing keys or invalid JSON. Return FULL JSON only.\nPrevious:\n{cleaned}\n\nRetry:\n{retry_prompt}"
+            stronger = model_router.escalate(stage, model)
+            if stronger != model:
+                print(f"{stage}: {model} failed validation, retrying on {stronger}")
+                model = stronger
+            hint = f"{retry_hint}\nError: {error}" if error else retry_hint
+            previous = clip_text(cleaned, RETRY_PREVIOUS_TOKENS)  # enough to show the mistake, not the whole reply
+            prompt = f"{hint}\nPrevious:\n{previous}\n\nRetry:\n{base_prompt}"
+    if fallback is not None:
+        print(f"{stage}: accepting output with schema errors after {retries} retries")
+        return fallback, True
     return cleaned, False
 
-# === Refinement (unchanged for now — can be improved later) ===
-def refine_spec(current_spec: dict, refinement_text: str, retries=2):
-    refine_path = os.path.join(PROMPTS_DIR, "v1_refine.md")
-    if "refine" not in prompt_templates:
-        with open(refine_path, "r", encoding="utf-8") as f:
-            prompt_templates["refine"] = f.read()
+def has_keys(*keys):
+    return lambda data: data if isinstance(data, dict) and all(k in data for k in keys) else None
+
+# === Step 1: Extract features ===
+async def extract_features(requirements_text: str, retries=2, use_cache=True, on_token=None):
+    prompt = build_prompt("features", [
+        PromptSection("requirements_text", requirements_text.strip())
+    ], "features")
+    return await generate_json(
+        prompt, lambda data: spec_validator.check_stage("features", data),
+        "INVALID JSON. Return only valid JSON matching the schema.",
+        max_tokens=2500, retries=retries, use_cache=use_cache, on_token=on_token, stage="features"
+    )
 
-    template = prompt_templates["refine"]
-    current_json = json.dumps(current_spec, indent=2)
-    prompt = template.replace("{current_spec}", current_json).replace("{refinement_text}", refinement_text.strip())
+# === Step 2: Generate user stories (now receives original requirements) ===
+# Large specs are sharded: one story call per group of modules, run with bounded
+# concurrency, so no single completion has to fit every module under max_tokens.
+STORY_SHARD_THRESHOLD = int(os.getenv("STORY_SHARD_THRESHOLD", "4"))    # shard when more modules than this
+STORY_SHARD_SIZE = int(os.getenv("STORY_SHARD_SIZE", "1"))              # modules per shard
+STORY_SHARD_CONCURRENCY = int(os.getenv("STORY_SHARD_CONCURRENCY", "4"))
+
+async def generate_story_batch(features_data: dict, original_requirements: str, retries=2, use_cache=True, on_token=None,
+                               size_key="stories"):
+    prompt = build_prompt("stories", [
+        PromptSection("original_requirements", original_requirements.strip(), [summarize_text]),
+        PromptSection("features_json", features_data)
+    ], "stories")
+
+    return await generate_json(
+        prompt, lambda data: spec_validator.check_stage("stories", data, unwrap=True),
+        "Invalid output. Return ONLY JSON with 'user_stories' array matching the schema.",
+        max_tokens=1500, retries=retries, use_cache=use_cache, on_token=on_token, stage="stories",
+        size_key=size_key
+    )
 
-    for attempt in range(retries + 1):
-        raw = llm_generate(prompt, max_tokens=3500)
-        cleaned = clean_json_output(raw)
-        try:
-            data = json.loads(cleaned)
-            required = ["modules", "features_by_module", "user_stories", "api_endpoints", "db_schema", "open_questions"]
-            if all(k in data for k in required):
-                return data, True
-        except json.JSONDecodeError:
-            pass
-        if attempt < retries:
-            prompt = f"Invalid or incomplete JSON. Return FULL refined spec.\nPrevious:\n{cleaned}\n\nRetry:\n{template.replace('{current_spec}', current_json).replace('{refinement_text}', refinement_text.strip())}"
-    return cleaned, False
+async def generate_stories(features_data: dict, original_requirements: str, retries=2, use_cache=True, on_token=None,
+                           sharded=None, shard_size=None, max_concurrency=None):
+    features_by_module = features_data.get("features_by_module") or {}
+    modules = [m for m in features_data.get("modules") or [] if m in features_by_module]
+    modules += [m for m in features_by_module if m not in modules]
+    if sharded is None:
+        sharded = len(modules) > STORY_SHARD_THRESHOLD
+    if not sharded or len(modules) <= 1:
+        return await generate_story_batch(features_data, original_requirements, retries, use_cache, on_token)
+
+    size = max(1, shard_size or STORY_SHARD_SIZE)
+    shards = [modules[i:i + size] for i in range(0, len(modules), size)]
+    semaphore = asyncio.Semaphore(max(1, max_concurrency or STORY_SHARD_CONCURRENCY))
+
+    async def run_shard(shard):
+        subset = {"modules": shard, "features_by_module": {m: features_by_module[m] for m in shard}}
+        sink = (lambda delta: on_token(delta, stage=f"stories:{', '.join(shard)}")) if on_token else None
+        async with semaphore:
+            # A shard's stories are a fraction of a full run's, so its sizes are learned separately
+            return await generate_story_batch(subset, original_requirements, retries, use_cache, sink,
+                                              size_key="stories_shard")
+
+    print(f"Generating stories in {len(shards)} shards")
+    outcomes = await asyncio.gather(*(run_shard(shard) for shard in shards))
+
+    # Merge in module order and renumber so IDs are stable regardless of completion order
+    stories = []
+    for shard, (data, ok) in zip(shards, outcomes):
+        if not ok:
+            print(f"Story shard failed: {', '.join(shard)}")
+            return data, False
+        for story in data:
+            if not isinstance(story, dict):
+                continue
+            if not story.get("module"):
+                story["module"] = shard[0]
+            stories.append(story)
+    for index, story in enumerate(stories, start=1):
+        story["id"] = f"US{index:03d}"
+    return stories, True
+
+# === Step 3: API endpoints, DB schema and open questions as concurrent sub-stages ===
+# Each sub-stage has its own prompt, token budget and retry loop, so a bad
+# open_questions answer never forces the endpoints to be regenerated.
+API_DB_SUBSTAGES = {
+    "api_endpoints":  {"prompt": "api",            "max_tokens": 2000},
+    "db_schema":      {"prompt": "db",             "max_tokens": 1500},
+    "open_questions": {"prompt": "open_questions", "max_tokens": 600},
+}
+
+async def generate_api_db(full_data_so_far: dict, original_requirements: str, retries=2, use_cache=True, on_token=None,
+                          done: dict = None, checkpoint=None):
+    # done: sub-stage outputs already checkpointed by an earlier attempt; they are not regenerated.
+    # checkpoint: optional async callback(key, value) called as soon as a sub-stage succeeds.
+    def sections():
+        # Trim order when over budget: story rationale, then a requirements summary, then stories entirely
+        return [
+            PromptSection("input_json", full_data_so_far, [without_story_rationale, without_stories]),
+            PromptSection("original_requirements", original_requirements.strip(), [summarize_text])
+        ]
+
+    def check_list(key):
+        return lambda data: spec_validator.check_stage(key, data)
+
+    async def run_substage(key, cfg):
+        if done and key in done:
+            return {key: done[key]}, True
+        sink = (lambda delta: on_token(delta, stage=key)) if on_token else None
+        data, ok = await generate_json(
+            build_prompt(cfg["prompt"], sections(), key), check_list(key),
+            f"Invalid JSON or missing '{key}' array. Return ONLY the JSON object.",
+            max_tokens=cfg["max_tokens"], retries=retries, use_cache=use_cache, on_token=sink, stage=key
+        )
+        if ok and checkpoint is not None:
+            await checkpoint(key, data[key])
+        return data, ok
+
+    keys = list(API_DB_SUBSTAGES)
+    outcomes = await asyncio.gather(*(run_substage(k, API_DB_SUBSTAGES[k]) for k in keys))
+
+    merged, failed = {}, {}
+    for key, (data, ok) in zip(keys, outcomes):
+        if ok:
+            merged[key] = data[key]
+        else:
+            failed[key] = data
+    if failed:
+        print(f"API/DB sub-stages failed: {', '.join(failed)}")
+        return failed, False
+    return merged, True
+
+# === Refinement: full regeneration of the spec ===
+async def refine_spec(current_spec: dict, refinement_text: str, retries=2, use_cache=True):
+    prompt = build_prompt("refine", [
+        PromptSection("current_spec", current_spec),
+        PromptSection("refinement_text", refinement_text.strip())
+    ], "refine")
+    required = ["modules", "features_by_module", "user_stories", "api_endpoints", "db_schema", "open_questions"]
+
+    def check(data):
+        if not has_keys(*required)(data):
+            return None
+        errors = spec_validator.errors("spec", data)
+        if errors:
+            raise SchemaViolation(errors, usable=data)
+        return data
+
+    return await generate_json(
+        prompt, check,
+        "Invalid or incomplete JSON. Return FULL refined spec.",
+        max_tokens=3500, retries=retries, use_cache=use_cache, stage="refine"
+    )
 
 # === Final validation ===
 def final_validate(data: dict):
-    try:
-        validate(instance=data, schema=FULL_SCHEMA)
-        return True, None
-    except ValidationError as e:
-        return False, str(e.message)
+    errors = spec_validator.errors("spec", data)
+    return (False, "; ".join(errors)) if errors else (True, None)
+
+# === Refinement: JSON Patch against the current spec ===
+# The model only emits the delta, so output tokens scale with the size of the change.
+async def refine_spec_patch(current_spec: dict, refinement_text: str, retries=2, use_cache=True):
+    prompt = build_prompt("refine_patch", [
+        PromptSection("current_spec", current_spec),
+        PromptSection("refinement_text", refinement_text.strip())
+    ], "refine_patch")
+
+    def check(data):
+        patch = data.get("patch") if isinstance(data, dict) else data
+        refined = apply_patch(current_spec, patch)  # raises JsonPatchError (a ValueError)
+        valid, err = final_validate(refined)
+        if not valid:
+            raise ValueError(f"Patched spec fails schema validation: {err}")
+        return refined, patch
+
+    return await generate_json(
+        prompt, check,
+        "The patch could not be applied. Return ONLY a JSON object with a 'patch' array of RFC 6902 operations.",
+        max_tokens=1500, retries=retries, use_cache=use_cache, stage="refine_patch"
+    )
+
+# === Versioned save (blocking SQLite write, run via asyncio.to_thread) ===
+def save_version(base_trace_id: str, spec: dict, entry_type: str, meta: dict, summary: str,
+                 clear_checkpoints: bool = False, expected_version: int = None, parent_version: int = None):
+    version = spec_store.save_version(base_trace_id, spec, entry_type, meta, summary,
+                                      expected_version=expected_version, clear_checkpoints=clear_checkpoints,
+                                      parent_version=parent_version)
+    print(f"v{version} saved → {base_trace_id}")
+    return version
+
+def new_trace_id() -> str:
+    return f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
 
 # === Main pipeline (updated to pass original requirements throughout) ===
-def run_pipeline(requirements_text: str, base_trace_id: str = None):
+async def run_pipeline(requirements_text: str, base_trace_id: str = None, use_cache: bool = True,
+                       on_event=None, stream_tokens: bool = False, resume: bool = False):
+    # on_event: optional async callback(event, data) fired as each stage completes (used by SSE streaming)
+    # resume: reuse the stage checkpoints already stored under base_trace_id
     if base_trace_id is None:
-        base_trace_id = f"trace_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        base_trace_id = new_trace_id()
 
-    trace_dir, version_file, latest_file, history_file, version = get_versioned_paths(base_trace_id)
+    # LLM calls made below are scheduled fairly under this trace ID and timed into one breakdown
+    owner = llm_owner.set(base_trace_id)
+    request_metrics = metrics.current_request.set(metrics.RequestMetrics())
+    outcome = "error"
+    try:
+        result, trace_id = await _run_pipeline_stages(requirements_text, base_trace_id, use_cache, on_event,
+                                                      stream_tokens, resume)
+        outcome = "ok" if result is not None else "failed"
+        return result, trace_id
+    finally:
+        metrics.requests_total.inc(kind="generation", outcome=outcome)
+        metrics.current_request.reset(request_metrics)
+        llm_owner.reset(owner)
+
+# Identical in-flight requests share one computation (see utils/singleflight.py)
+generation_flights = SingleFlight()
+refinement_flights = SingleFlight()
+
+# Traces with a fresh (non-resume) generation running on them: a resume would race it for the same checkpoints
+generating = Counter()
+
+class GenerationInProgress(Exception):
+    pass
+
+@contextlib.contextmanager
+def _generating(trace_id: str, active: bool = True):
+    if not active:
+        yield
+        return
+    generating[trace_id] += 1
+    try:
+        yield
+    finally:
+        generating[trace_id] -= 1
+        if not generating[trace_id]:
+            del generating[trace_id]
+
+async def _run_pipeline_stages(requirements_text: str, base_trace_id: str, use_cache: bool, on_event,
+                               stream_tokens: bool, resume: bool):
+    print(f"\nPipeline {'resumed' if resume else 'started'} → {base_trace_id}\n")
+    if on_event is not None:
+        await on_event("started", {"trace_id": base_trace_id})
+
+    # A double-click or a frontend retry joins the generation already running for the same text;
+    # each caller still gets its own trace record below. Any resume of a trace (HTTP or a retried job)
+    # joins the resume already running on it, whatever its options.
+    if resume:
+        key = flight_key("resume", base_trace_id)
+    else:
+        key = flight_key("generate", MODEL, normalize_text(requirements_text), use_cache, stream_tokens)
+
+    async def compute(publish):
+        # Registered for as long as the stages run: the flight outlives its first caller while others wait on it
+        with _generating(base_trace_id, active=not resume):
+            return await _generate_spec(requirements_text, use_cache, publish, stream_tokens, base_trace_id, resume)
+
+    with _generating(base_trace_id, active=not resume):
+        computed, shared = await generation_flights.run(key, compute, on_event=on_event)
+        if computed["spec"] is None:
+            # Checkpoints are kept under the trace that ran the stages, which is the leader's when coalesced
+            return None, computed["trace_id"]
+
+        result = copy.deepcopy(computed["spec"]) if shared else computed["spec"]
+        meta = {"metrics": computed["metrics"], "prompt_versions": computed["prompt_versions"]}
+        if shared:
+            print(f"Coalesced with in-flight generation {computed['trace_id']}")
+            metrics.coalesced.inc(kind="generation")
+            meta["coalesced_from"] = computed["trace_id"]
+
+        # Save versioned spec (version is allocated at save time, off the event loop)
+        version = await asyncio.to_thread(
+            save_version, base_trace_id, result, "initial_generation", meta,
+            requirements_text[:150] + "..." if len(requirements_text) > 150 else requirements_text, True
+        )
+    if on_event is not None:
+        await on_event("complete", {"trace_id": base_trace_id, "version": version, "valid": computed["valid"], "spec": result})
+    return result, base_trace_id
 
-    print(f"\nPipeline started → {base_trace_id} (v{version})\n")
+async def _generate_spec(requirements_text: str, use_cache: bool, publish, stream_tokens: bool,
+                         trace_id: str, resume: bool = False):
+    # Stages 1-3 plus validation. Events go to every coalesced caller through publish.
+    # Each validated stage output is checkpointed under trace_id, so a failed or interrupted
+    # run can be resumed from the first incomplete stage.
+    def token_sink(stage):
+        if not stream_tokens:
+            return None
+        return lambda delta, stage=stage: publish("token", {"stage": stage, "delta": delta})
+
+    async def checkpoint(stage, data):
+        await asyncio.to_thread(spec_store.save_checkpoint, trace_id, stage, data)
+
+    done = await asyncio.to_thread(spec_store.get_checkpoints, trace_id) if resume else {}
+    if done:
+        print(f"Resuming with checkpoints: {', '.join(sorted(done))}")
+    if "input" not in done:
+        await checkpoint("input", {"requirements_text": requirements_text})
+    failed = {"spec": None, "trace_id": trace_id}
 
     # Step 1: Extract features
-    features, ok = extract_features(requirements_text)
-    if not ok:
-        print("Feature extraction failed.")
-        return None, base_trace_id
+    if "features" in done:
+        features = done["features"]
+    else:
+        with metrics.timed_stage("features"):
+            features, ok = await extract_features(requirements_text, use_cache=use_cache,
+                                                  on_token=token_sink("features"))
+        if not ok:
+            print("Feature extraction failed.")
+            await publish("error", {"stage": "features", "detail": "Feature extraction failed."})
+            return failed
+        await checkpoint("features", features)
     result = features.copy()
+    await publish("features", features)
 
     # Step 2: Generate user stories (pass original text)
-    stories, ok = generate_stories(features, requirements_text)
-    if not ok:
-        print("User stories generation failed.")
-        return None, base_trace_id
+    if "stories" in done:
+        stories = done["stories"]
+    else:
+        with metrics.timed_stage("stories"):
+            stories, ok = await generate_stories(features, requirements_text, use_cache=use_cache,
+                                                 on_token=token_sink("stories"))
+        if not ok:
+            print("User stories generation failed.")
+            await publish("error", {"stage": "stories", "detail": "User stories generation failed."})
+            return failed
+        await checkpoint("stories", stories)
     result["user_stories"] = stories
+    await publish("stories", {"user_stories": stories})
 
-    # Step 3: Generate API, DB, open questions (pass original text)
-    addition, ok = generate_api_db(result, requirements_text)
+    # Step 3: Generate API, DB, open questions (pass original text); sub-stages are checkpointed one by one
+    with metrics.timed_stage("api_db"):
+        addition, ok = await generate_api_db(result, requirements_text, use_cache=use_cache,
+                                             on_token=token_sink("api_db"), done=done, checkpoint=checkpoint)
     if not ok:
         print("API/DB generation failed.")
-        return None, base_trace_id
+        await publish("error", {"stage": "api_db", "detail": "API/DB generation failed."})
+        return failed
     result.update(addition)
+    await publish("api_db", addition)
 
     # Final schema validation
-    valid, err = final_validate(result)
+    with metrics.timed_stage("validation"):
+        valid, err = final_validate(result)
     if not valid:
         print(f"Final validation failed: {err}")
 
-    # Save versioned spec
-    spec_data = {
-        "version": version,
-        "generated_at": datetime.now().isoformat(),
-        "trace_id": base_trace_id,
-        "type": "initial_generation",
-        "spec": result
-    }
-    with open(version_file, "w", encoding="utf-8") as f:
-        json.dump(spec_data, f, indent=2, ensure_ascii=False)
-
-    # Update latest
-    with open(latest_file, "w", encoding="utf-8") as f:
-        json.dump({"current_version": version, "trace_id": base_trace_id, **result}, f, indent=2)
-
-    # Update history
-    history = []
-    if os.path.exists(history_file):
-        with open(history_file, "r") as f:
-            history = json.load(f)
-    history.append({
-        "version": version,
-        "file": f"v{version}.json",
-        "generated_at": datetime.now().isoformat(),
-        "type": "initial_generation",
-        "requirements_summary": requirements_text[:150] + "..." if len(requirements_text) > 150 else requirements_text
-    })
-    with open(history_file, "w") as f:
-        json.dump(history, f, indent=2)
-
-    print(f"v{version} saved → {version_file}")
-    return result, base_trace_id
+    return {"spec": result, "valid": valid, "trace_id": trace_id,
+            "metrics": metrics.current_request.get().as_dict(),
+            "prompt_versions": metrics.current_request.get().prompt_versions}
+
+async def resume_pipeline(trace_id: str, use_cache: bool = True, on_event=None):
+    """Continue a failed or interrupted generation from its first incomplete stage.
+
+    Returns (spec, trace_id), or (None, trace_id) when the trace has no checkpoints to resume from.
+    Raises GenerationInProgress while a fresh generation is still running on the trace.
+    """
+    if generating[trace_id]:
+        raise GenerationInProgress(f"{trace_id} is still generating")
+    done = await asyncio.to_thread(spec_store.get_checkpoints, trace_id)
+    if "input" not in done:
+        return None, trace_id
+    return await run_pipeline(done["input"]["requirements_text"], base_trace_id=trace_id, use_cache=use_cache,
+                              on_event=on_event, resume=True)
+
+# === Streaming pipeline: yields (event, data) pairs as stages finish ===
+async def stream_pipeline(requirements_text: str, use_cache: bool = True, stream_tokens: bool = False):
+    queue = asyncio.Queue()
+    done = object()
+
+    async def on_event(event, data):
+        await queue.put((event, data))
+
+    async def runner():
+        try:
+            await run_pipeline(requirements_text, use_cache=use_cache, on_event=on_event, stream_tokens=stream_tokens)
+        except Exception as e:
+            await queue.put(("error", {"stage": "pipeline", "detail": str(e)}))
+        finally:
+            await queue.put(done)
 
-# === Refinement pipeline (unchanged) ===
-def run_refinement(current_spec: dict, refinement_text: str, base_trace_id: str):
-    trace_dir, version_file, latest_file, history_file, version = get_versioned_paths(base_trace_id)
+    task = asyncio.create_task(runner())
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            yield item
+    finally:
+        # Client went away: stop paying for the remaining stages
+        if not task.done():
+            task.cancel()
+
+# === Batch generation: many documents, results yielded as each one finishes ===
+async def run_batch(documents: list, use_cache: bool = True, tickets: list = None):
+    # Documents run concurrently; llm_scheduler bounds the provider calls and interleaves them fairly.
+    # tickets: one admission ticket per document, held while that document runs.
+    async def run_one(index, text):
+        try:
+            with tickets[index] if tickets else contextlib.nullcontext():
+                spec, trace_id = await run_pipeline(text, use_cache=use_cache)
+            return {"index": index, "trace_id": trace_id, "ok": spec is not None, "spec": spec}
+        except Exception as e:
+            return {"index": index, "trace_id": None, "ok": False, "error": str(e)}
 
-    print(f"\nRefinement started → {base_trace_id} (v{version})\n")
+    tasks = [asyncio.create_task(run_one(i, text)) for i, text in enumerate(documents)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+# === Background jobs: generations that outlive the HTTP request ===
+# Jobs persist in backend/app/logs/jobs.sqlite3, so a restart picks up where it left off.
+job_queue = JobQueue(
+    os.getenv("JOB_DB_PATH", os.path.join(OUTPUT_DIR, "jobs.sqlite3")),
+    lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", "60")),
+    max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+)
+
+async def run_generation_job(job: dict, emit):
+    # The trace ID is fixed when the job is queued, so a retried job keeps writing to the same trace
+    payload = job["payload"]
+    completed = {}
+
+    async def on_event(event, data):
+        if event == "complete":
+            completed.update(data)
+            data = {k: v for k, v in data.items() if k != "spec"}  # clients fetch the spec from the job
+        await emit(event, data)
+
+    # A retried job continues from the checkpoints of the attempt that died; if that attempt
+    # got as far as saving the spec, the saved version is the result
+    if job["attempts"] > 1:
+        record = await asyncio.to_thread(spec_store.get_latest, job["trace_id"])
+        if record is not None and record["type"] == "initial_generation":
+            return {"trace_id": job["trace_id"], "version": record["version"], "valid": final_validate(record["spec"])[0]}
+
+    spec, trace_id = await run_pipeline(payload["requirements_text"], base_trace_id=job["trace_id"],
+                                        use_cache=payload.get("use_cache", True), on_event=on_event, resume=True)
+    if spec is None:
+        raise JobFailed(f"Generation failed. Trace: {trace_id}")
+    return {"trace_id": trace_id, "version": completed["version"], "valid": completed["valid"]}
+
+job_workers = JobWorkerPool(job_queue, run_generation_job, concurrency=int(os.getenv("JOB_WORKERS", "2")))
+
+# === Refinement pipeline ===
+async def run_refinement(current_spec: dict, refinement_text: str, base_trace_id: str, use_cache: bool = True,
+                         mode: str = "patch", base_version: int = None, expected_version: int = None):
+    # mode="patch" asks for a JSON Patch and falls back to full regeneration if it cannot be applied
+    # current_spec=None refines the stored spec (base_version, or the latest) instead of a client copy.
+    # expected_version: save only if the trace is still at this version, else VersionConflict.
+    owner = llm_owner.set(base_trace_id)
+    request_metrics = metrics.current_request.set(metrics.RequestMetrics())
+    outcome = "error"
+    try:
+        if expected_version is not None or current_spec is None:
+            latest = await asyncio.to_thread(spec_store.latest_version, base_trace_id)
+            if expected_version is not None and latest != expected_version:
+                # Fail before spending any LLM calls; save_version checks again atomically
+                raise VersionConflict(f"{base_trace_id} is at v{latest}, expected v{expected_version}")
+        if current_spec is None:
+            version, current_spec = await asyncio.to_thread(spec_store.get_spec, base_trace_id, base_version)
+            if current_spec is None:
+                raise SpecNotFound(f"Unknown trace or version: {base_trace_id}"
+                                   f"{f' v{base_version}' if base_version is not None else ''}")
+            spec_key = f"v{version}"
+        else:
+            version = None  # a client copy: recorded as derived from whatever is latest when it is saved
+            spec_key = json.dumps(current_spec, sort_keys=True)
+
+        # A repeated submit of the same refinement on the same trace waits for the first one instead
+        # of saving a duplicate version
+        key = flight_key("refine", MODEL, base_trace_id, spec_key, normalize_text(refinement_text), mode,
+                         use_cache, expected_version)
+        (refined, trace_id), shared = await refinement_flights.run(
+            key, lambda publish: _run_refinement(current_spec, refinement_text, base_trace_id, use_cache, mode,
+                                                 expected_version, version)
+        )
+        if shared:
+            print(f"Coalesced with in-flight refinement on {base_trace_id}")
+            metrics.coalesced.inc(kind="refinement")
+            refined = copy.deepcopy(refined)
+        outcome = "ok" if refined is not None else "failed"
+        return refined, trace_id
+    finally:
+        metrics.requests_total.inc(kind="refinement", outcome=outcome)
+        metrics.current_request.reset(request_metrics)
+        llm_owner.reset(owner)
+
+async def _run_refinement(current_spec: dict, refinement_text: str, base_trace_id: str, use_cache: bool, mode: str,
+                          expected_version: int = None, parent_version: int = None):
+    print(f"\nRefinement started → {base_trace_id} ({mode})\n")
+
+    extra = {"refinement_instruction": refinement_text, "refinement_mode": mode}
+    refined, ok = None, False
+    if mode == "patch":
+        with metrics.timed_stage("refine_patch"):
+            outcome, ok = await refine_spec_patch(current_spec, refinement_text, use_cache=use_cache)
+        if ok:
+            refined, extra["patch"] = outcome
+        else:
+            print("Patch refinement failed, falling back to full regeneration.")
+            extra["refinement_mode"] = "full"
 
-    refined, ok = refine_spec(current_spec, refinement_text)
+    if not ok:
+        with metrics.timed_stage("refine"):
+            refined, ok = await refine_spec(current_spec, refinement_text, use_cache=use_cache)
     if not ok:
         print("Refinement failed after retries.")
         return None, base_trace_id
 
-    valid, err = final_validate(refined)
+    with metrics.timed_stage("validation"):
+        valid, err = final_validate(refined)
     if not valid:
         print(f"Refined spec validation failed: {err}")
+    extra["metrics"] = metrics.current_request.get().as_dict()
+    extra["prompt_versions"] = metrics.current_request.get().prompt_versions
 
     # Save new version
-    spec_data = {
-        "version": version,
-        "generated_at": datetime.now().isoformat(),
-        "parent_version": version - 1,
-        "trace_id": base_trace_id,
-        "type": "refinement",
-        "refinement_instruction": refinement_text,
-        "spec": refined
-    }
-    with open(version_file, "w", encoding="utf-8") as f:
-        json.dump(spec_data, f, indent=2, ensure_ascii=False)
-
-    # Update latest
-    with open(latest_file, "w", encoding="utf-8") as f:
-        json.dump({"current_version": version, "trace_id": base_trace_id, **refined}, f, indent=2)
-
-    # Update history
-    history = []
-    if os.path.exists(history_file):
-        with open(history_file, "r") as f:
-            history = json.load(f)
-    history.append({
-        "version": version,
-        "file": f"v{version}.json",
-        "generated_at": datetime.now().isoformat(),
-        "type": "refinement",
-        "instruction_summary": refinement_text[:100] + "..." if len(refinement_text) > 100 else refinement_text
-    })
-    with open(history_file, "w") as f:
-        json.dump(history, f, indent=2)
-
-    print(f"v{version} saved → {version_file}")
+    await asyncio.to_thread(
+        save_version, base_trace_id, refined, "refinement", extra,
+        refinement_text[:100] + "..." if len(refinement_text) > 100 else refinement_text, False, expected_version,
+        parent_version
+    )
     return refined, base_trace_id
 
 # === Local testing ===
@@ -299,6 +840,6 @@ if __name__ == "__main__":
     if os.path.exists(sample_file):
         with open(sample_file, "r", encoding="utf-8") as f:
             text = f.read()
-        run_pipeline(text)
+        asyncio.run(run_pipeline(text))
     else:
         print("Sample file not found.")
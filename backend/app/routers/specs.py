@@ -1,11 +1,53 @@
 # backend/app/routers/specs.py
-from fastapi import APIRouter, Request, HTTPException, status
+import json
+import asyncio
+from typing import List, Literal, Optional
+from fastapi import APIRouter, Request, HTTPException, Header, status
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel, Field, validator
-from ..pipeline import run_pipeline, run_refinement
-from ..utils.rate_limiter import limiter
+from ..pipeline import (run_pipeline, run_refinement, resume_pipeline, stream_pipeline, run_batch, spec_store,
+                        llm_scheduler, hedger, model_router, admission, prompts, schemas, job_queue, job_workers,
+                        new_trace_id, GenerationInProgress)
+from ..utils.job_queue import public_job, TERMINAL
+from ..utils.spec_store import SpecNotFound, VersionConflict
+from ..utils.admission import Overloaded
+from ..utils.rate_limiter import limiter, ROUTE_COSTS
+from ..utils.llm_cache import llm_cache
+from ..utils.json_repair import repair_stats
 
 router = APIRouter()
 
+# === Rate limiting: per-client token bucket, weighted by route cost ===
+async def enforce_rate_limit(request: Request, route: str, units: int = 1):
+    cost = ROUTE_COSTS.get(route, 1) * units
+    if limiter.backend.blocking:
+        allowed, retry_after = await asyncio.to_thread(limiter.check, request.client.host, cost)
+    else:
+        allowed, retry_after = limiter.check(request.client.host, cost)
+    if not allowed:
+        headers = {"Retry-After": str(retry_after)} if retry_after != float("inf") else None
+        raise HTTPException(status_code=429, detail="Rate limit exceeded", headers=headers)
+
+# === Admission control: shed load with a fast 503 once the LLM backlog exceeds the lane's deadline ===
+def admit(lane: str):
+    try:
+        return admission.admit(lane)
+    except Overloaded as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def admit_each(lane: str, count: int) -> list:
+    # One ticket per unit of work, all or nothing; each ticket raises the wait the next one sees
+    tickets = []
+    try:
+        for _ in range(count):
+            tickets.append(admit(lane))
+    except HTTPException:
+        for ticket in tickets:
+            ticket.release()
+        raise
+    return tickets
+
 # === Generate new spec ===
 class GenerateRequest(BaseModel):
     requirements_text: str = Field(
@@ -14,6 +56,7 @@ class GenerateRequest(BaseModel):
         max_length=10000,
         description="Detailed product requirements (at least 50 characters to ensure meaningful output)"
     )
+    bypass_cache: bool = Field(False, description="Skip cached LLM responses and force fresh generation")
 
     @validator("requirements_text")
     def strip_and_check(cls, v):
@@ -30,20 +73,169 @@ class GenerateRequest(BaseModel):
 
 @router.post("/generate")
 async def generate_spec(request: Request, body: GenerateRequest):
-    client_ip = request.client.host
-    if not limiter.is_allowed(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
+    await enforce_rate_limit(request, "generate")
 
-    spec, trace_id = run_pipeline(body.requirements_text)
+    with admit("generation"):
+        spec, trace_id = await run_pipeline(body.requirements_text, use_cache=not body.bypass_cache)
     if spec is None:
-        raise HTTPException(status_code=500, detail=f"Generation failed. Trace: {trace_id}")
+        raise HTTPException(
+            status_code=500,
+            detail=f"Generation failed. Trace: {trace_id}. Completed stages are kept; retry with POST /specs/traces/{trace_id}/resume"
+        )
     return {"trace_id": trace_id, "spec": spec}
 
+# === Generate with Server-Sent Events: one event per completed stage ===
+class StreamGenerateRequest(GenerateRequest):
+    stream_tokens: bool = Field(False, description="Also emit raw 'token' events while each stage is generating")
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/generate/stream")
+async def generate_spec_stream(request: Request, body: StreamGenerateRequest):
+    await enforce_rate_limit(request, "generate_stream")
+    ticket = admit("generation")
+
+    async def events():
+        with ticket:
+            async for event, data in stream_pipeline(
+                body.requirements_text,
+                use_cache=not body.bypass_cache,
+                stream_tokens=body.stream_tokens
+            ):
+                yield sse_event(event, data)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(ticket.release)  # in case the stream never starts
+    )
+
+# === Batch generation: one SSE "item" event per document as it finishes ===
+class BatchGenerateRequest(BaseModel):
+    documents: List[str] = Field(..., min_length=1, max_length=50)
+    bypass_cache: bool = False
+
+    @validator("documents")
+    def strip_and_check(cls, docs):
+        stripped = [d.strip() for d in docs]
+        for i, d in enumerate(stripped):
+            if len(d) < 50 or len(d) > 10000:
+                raise ValueError(f"Document {i} must be between 50 and 10000 characters (got {len(d)})")
+        return stripped
+
+@router.post("/batch")
+async def generate_batch(request: Request, body: BatchGenerateRequest):
+    max_documents = int(limiter.capacity // ROUTE_COSTS["batch"])
+    if len(body.documents) > max_documents:
+        raise HTTPException(status_code=413, detail=f"A batch may hold at most {max_documents} documents")
+    await enforce_rate_limit(request, "batch", units=len(body.documents))
+    tickets = admit_each("generation", len(body.documents))
+
+    def release_all():
+        for ticket in tickets:
+            ticket.release()
+
+    async def events():
+        succeeded = 0
+        try:
+            async for item in run_batch(body.documents, use_cache=not body.bypass_cache, tickets=tickets):
+                succeeded += item["ok"]
+                yield sse_event("item", item)
+            yield sse_event("done", {"total": len(body.documents), "succeeded": succeeded})
+        finally:
+            release_all()
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(release_all)  # in case the stream never starts
+    )
+
+@router.get("/scheduler/stats")
+async def scheduler_stats():
+    return dict(llm_scheduler.stats(), hedging=hedger.get_stats(), admission=admission.get_stats())
+
+@router.get("/prompts")
+async def prompt_versions():
+    return {"prompts": prompts.get_stats(), "schemas": schemas.get_stats()}
+
+@router.get("/router/stats")
+async def router_stats():
+    return model_router.get_stats()
+
+# === Background jobs: returns at once, the pipeline runs in a worker ===
+@router.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_job(request: Request, body: GenerateRequest, idempotency_key: str = Header(None)):
+    await enforce_rate_limit(request, "jobs")
+
+    # Retrying the POST with the same Idempotency-Key returns the original job instead of a new one
+    job = await asyncio.to_thread(
+        job_queue.enqueue, "generate",
+        {"requirements_text": body.requirements_text, "use_cache": not body.bypass_cache},
+        new_trace_id(), idempotency_key
+    )
+    job_workers.notify()
+    return public_job(job)
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    response = public_job(job)
+    if job["status"] == "succeeded":
+        record = await asyncio.to_thread(spec_store.get_version, job["trace_id"], job["result"]["version"])
+        response["spec"] = record["spec"] if record else None
+    return response
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+
+    async def events():
+        # Live stage events when the job runs in this process; polling covers jobs run by other workers
+        queue = job_workers.subscribe(job_id)
+        try:
+            current = job
+            yield sse_event("status", public_job(current))
+            seen = (current["status"], current["progress"])
+            while current["status"] not in TERMINAL:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), timeout=2)
+                except asyncio.TimeoutError:
+                    current = await asyncio.to_thread(job_queue.get, job_id)
+                    if (current["status"], current["progress"]) != seen:
+                        seen = (current["status"], current["progress"])
+                        yield sse_event("status", public_job(current))
+                    continue
+                yield sse_event(event, data)
+                if event == "status" and data["status"] in TERMINAL:
+                    break
+        finally:
+            job_workers.unsubscribe(job_id, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 # === Refine existing spec ===
 class RefineRequest(BaseModel):
-    current_spec: dict
     refinement_text: str = Field(..., min_length=10, max_length=2000)
     trace_id: str  # Required: same trace_id from original generation
+    current_spec: Optional[dict] = Field(None, description="Deprecated: omit it and the stored spec is refined")
+    base_version: Optional[int] = Field(None, ge=1, description="Stored version to refine (default: latest)")
+    expected_version: Optional[int] = Field(
+        None, ge=1, description="Only save if the trace is still at this version; otherwise 409"
+    )
+    bypass_cache: bool = False
+    mode: Literal["patch", "full"] = Field("patch", description="'patch' returns only the delta; 'full' regenerates the whole spec")
 
     @validator("refinement_text")
     def strip_and_check(cls, v):
@@ -52,17 +244,90 @@ class RefineRequest(BaseModel):
             raise ValueError("Refinement text cannot be empty")
         return stripped
 
+    @validator("base_version")
+    def base_version_needs_stored_spec(cls, v, values):
+        if v is not None and values.get("current_spec") is not None:
+            raise ValueError("base_version selects a stored spec; it cannot be combined with current_spec")
+        return v
+
 @router.post("/refine")
 async def refine_spec_endpoint(request: Request, body: RefineRequest):
-    client_ip = request.client.host
-    if not limiter.is_allowed(client_ip):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded")
-
-    refined_spec, trace_id = run_refinement(
-        current_spec=body.current_spec,
-        refinement_text=body.refinement_text,
-        base_trace_id=body.trace_id  # Pass the original trace_id
-    )
+    await enforce_rate_limit(request, "refine")
+
+    try:
+        with admit("refinement"):
+            refined_spec, trace_id = await run_refinement(
+                current_spec=body.current_spec,
+                refinement_text=body.refinement_text,
+                base_trace_id=body.trace_id,  # Pass the original trace_id
+                use_cache=not body.bypass_cache,
+                mode=body.mode,
+                base_version=body.base_version,
+                expected_version=body.expected_version
+            )
+    except SpecNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except VersionConflict as e:
+        raise HTTPException(status_code=409, detail=f"Spec was changed by another request: {e}")
     if refined_spec is None:
         raise HTTPException(status_code=500, detail=f"Refinement failed. Trace: {trace_id}")
-    return {"trace_id": trace_id, "spec": refined_spec}
\ No newline at end of file
+    return {"trace_id": trace_id, "spec": refined_spec}
+
+# === LLM cache stats ===
+@router.get("/cache/stats")
+async def cache_stats():
+    return llm_cache.get_stats()
+
+# === Local JSON repair stats ===
+@router.get("/repair/stats")
+async def repair_stats_endpoint():
+    return repair_stats
+
+# === Stored specs: latest version, history and any past version ===
+@router.get("/traces")
+async def list_traces(limit: int = 50, offset: int = 0):
+    return await asyncio.to_thread(spec_store.list_traces, min(limit, 200), offset)
+
+@router.get("/traces/{trace_id}")
+async def get_latest_spec(trace_id: str):
+    record = await asyncio.to_thread(spec_store.get_latest, trace_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Unknown trace: {trace_id}")
+    return record
+
+@router.get("/traces/{trace_id}/history")
+async def get_spec_history(trace_id: str):
+    history = await asyncio.to_thread(spec_store.get_history, trace_id)
+    if not history:
+        raise HTTPException(status_code=404, detail=f"Unknown trace: {trace_id}")
+    return {"trace_id": trace_id, "history": history}
+
+@router.get("/traces/{trace_id}/versions/{version}")
+async def get_spec_version(trace_id: str, version: int):
+    record = await asyncio.to_thread(spec_store.get_version, trace_id, version)
+    if record is None:
+        raise HTTPException(status_code=404, detail=f"Unknown version: {trace_id} v{version}")
+    return record
+
+# === Stage checkpoints of failed or interrupted generations ===
+@router.get("/traces/{trace_id}/checkpoints")
+async def get_checkpoints(trace_id: str):
+    done = await asyncio.to_thread(spec_store.get_checkpoints, trace_id)
+    if not done:
+        raise HTTPException(status_code=404, detail=f"No checkpoints for trace: {trace_id}")
+    return {"trace_id": trace_id, "completed_stages": sorted(stage for stage in done if stage != "input")}
+
+@router.post("/traces/{trace_id}/resume")
+async def resume_generation(request: Request, trace_id: str, bypass_cache: bool = False):
+    await enforce_rate_limit(request, "resume")
+
+    if not await asyncio.to_thread(spec_store.get_checkpoints, trace_id):
+        raise HTTPException(status_code=404, detail=f"Nothing to resume for trace: {trace_id}")
+    try:
+        with admit("generation"):
+            spec, trace_id = await resume_pipeline(trace_id, use_cache=not bypass_cache)
+    except GenerationInProgress as e:
+        raise HTTPException(status_code=409, detail=f"Generation still running, resume once it fails: {e}")
+    if spec is None:
+        raise HTTPException(status_code=500, detail=f"Generation failed again. Trace: {trace_id}")
+    return {"trace_id": trace_id, "spec": spec}
@@ -0,0 +1,110 @@
+# backend/app/utils/admission.py
+import math
+from contextvars import ContextVar
+from .metrics import admission_rejected
+
+# The admission ticket of the request being served, so its LLM calls can be counted
+current_ticket = ContextVar("admission_ticket", default=None)
+
+
+class Overloaded(Exception):
+    def __init__(self, lane: str, retry_after: int, detail: str):
+        super().__init__(detail)
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    def __init__(self, controller, lane: str):
+        self.controller = controller
+        self.lane = lane
+        self.llm_calls = 0
+        self.released = False
+        self._token = None
+
+    def __enter__(self):
+        self._token = current_ticket.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            current_ticket.reset(self._token)
+        except ValueError:
+            pass  # a streaming response closed from another context
+        self.release()
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._leave(self)
+
+
+class AdmissionController:
+    """Global admission control in front of the LLM-backed routes.
+
+    The wait a new request would see is estimated from the work already
+    admitted: LLM calls still to come for the pipelines in flight (or the
+    calls queued at the scheduler, whichever is larger), spread over the
+    scheduler's slots at the observed per-call latency. Once that exceeds a
+    lane's deadline the request is refused at once with a Retry-After, so
+    the requests already admitted still finish in time.
+
+    Lanes get their own deadline and concurrency cap; refinements (one or two
+    calls, a user waiting on them) are given a longer deadline than new
+    generations, so under load generations are shed first.
+    """
+
+    def __init__(self, scheduler, lanes: dict, call_seconds: float = 2.0, smoothing: float = 0.1):
+        self.scheduler = scheduler
+        self.lanes = lanes                  # lane -> {"max_wait": s, "max_in_flight": n, "calls": expected calls}
+        self.call_seconds = call_seconds    # EWMA of uncached LLM call latency
+        self.smoothing = smoothing
+        self.in_flight = {lane: 0 for lane in lanes}
+        self.calls_per_request = {lane: float(cfg["calls"]) for lane, cfg in lanes.items()}
+        self.stats = {lane: {"admitted": 0, "rejected": 0} for lane in lanes}
+
+    def estimate_wait(self) -> float:
+        remaining = sum(self.in_flight[lane] * self.calls_per_request[lane] / 2 for lane in self.lanes)
+        pending = max(self.scheduler.queued, remaining)
+        return pending * self.call_seconds / max(1, self.scheduler.max_in_flight)
+
+    def admit(self, lane: str) -> _Ticket:
+        """Take a ticket for `lane` (use it as a context manager) or raise Overloaded."""
+        cfg = self.lanes[lane]
+        wait = self.estimate_wait()
+        if self.in_flight[lane] >= cfg["max_in_flight"]:
+            detail = f"Too many {lane} requests in progress"
+        elif wait > cfg["max_wait"]:
+            detail = f"Server busy: estimated wait {wait:.0f}s exceeds {cfg['max_wait']:.0f}s"
+        else:
+            self.in_flight[lane] += 1
+            self.stats[lane]["admitted"] += 1
+            return _Ticket(self, lane)
+        self.stats[lane]["rejected"] += 1
+        admission_rejected.inc(lane=lane)
+        # Roughly when enough of the admitted work will have drained
+        excess = wait - cfg["max_wait"] if wait > cfg["max_wait"] else self.call_seconds
+        retry_after = max(1, math.ceil(excess))
+        raise Overloaded(lane, retry_after, detail)
+
+    def observe_call(self, seconds: float):
+        # Called for every uncached LLM call
+        self.call_seconds += self.smoothing * (seconds - self.call_seconds)
+        ticket = current_ticket.get()
+        if ticket is not None:
+            ticket.llm_calls += 1
+
+    def _leave(self, ticket: _Ticket):
+        self.in_flight[ticket.lane] -= 1
+        if ticket.llm_calls:  # coalesced and cached requests made no calls of their own
+            expected = self.calls_per_request[ticket.lane]
+            self.calls_per_request[ticket.lane] = expected + self.smoothing * (ticket.llm_calls - expected)
+
+    def get_stats(self) -> dict:
+        return {
+            "estimated_wait_seconds": round(self.estimate_wait(), 3),
+            "call_seconds": round(self.call_seconds, 3),
+            "lanes": {lane: dict(self.stats[lane], in_flight=self.in_flight[lane],
+                                 calls_per_request=round(self.calls_per_request[lane], 2), **cfg)
+                      for lane, cfg in self.lanes.items()}
+        }
@@ -0,0 +1,102 @@
+# backend/app/utils/hedging.py
+import asyncio
+from collections import Counter, deque
+from .metrics import hedged_calls
+
+
+class Hedger:
+    """Hedged requests: when a call is slower than usual for its stage, race a duplicate.
+
+    The deadline is the `percentile` of recent uncached call latencies for the
+    stage, so only the slow tail gets a second request. The first result that
+    accept() approves wins and the other call is cancelled.
+
+    Extra load is capped by a budget: every primary call earns `max_extra`
+    of a hedge (up to `burst`), and firing a hedge spends a whole one, so in
+    the long run hedges stay under max_extra * primary calls.
+    """
+
+    def __init__(self, stages=(), percentile: float = 0.95, max_extra: float = 0.1, burst: float = 5,
+                 min_samples: int = 20, window: int = 200, min_delay: float = 0.5):
+        self.stages = set(stages)   # "*" hedges every stage
+        self.percentile = percentile
+        self.max_extra = max_extra
+        self.burst = burst
+        self.min_samples = min_samples
+        self.window = window
+        self.min_delay = min_delay
+        self.latencies = {}         # stage -> deque of recent seconds
+        self.credits = 0.0
+        self.stats = Counter()
+
+    def enabled(self, stage: str) -> bool:
+        return stage is not None and ("*" in self.stages or stage in self.stages)
+
+    def observe(self, stage: str, seconds: float):
+        self.latencies.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    def deadline(self, stage: str):
+        """Seconds to wait before hedging, or None until enough latencies have been seen."""
+        samples = self.latencies.get(stage)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return max(self.min_delay, ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))])
+
+    async def run(self, stage: str, call, accept, allow=None):
+        """Run call() (a coroutine factory), hedging it once if it misses the stage deadline.
+
+        accept(result) decides whether a result may win. When neither call is
+        accepted the primary's result is returned so the caller's retry path
+        handles it. allow() is checked just before firing, e.g. to skip hedging
+        while the provider is saturated.
+        """
+        delay = self.deadline(stage) if self.enabled(stage) else None
+        if delay is None:
+            return await call()
+        self.credits = min(self.burst, self.credits + self.max_extra)
+
+        tasks = [asyncio.ensure_future(call())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                if self.credits < 1 or (allow is not None and not allow()):
+                    self._count(stage, "skipped")
+                else:
+                    self.credits -= 1
+                    self._count(stage, "fired")
+                    tasks.append(asyncio.ensure_future(call()))
+
+            pending, results, errors = set(tasks), {}, []
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in [t for t in tasks if t in done]:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                        continue
+                    result = task.result()
+                    if accept(result):
+                        if task is not tasks[0]:
+                            self._count(stage, "won")
+                        return result
+                    results[task] = result
+            if results:
+                return results.get(tasks[0], next(iter(results.values())))
+            raise errors[0]
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _count(self, stage: str, outcome: str):
+        self.stats[f"{outcome}:{stage}"] += 1
+        self.stats[outcome] += 1
+        hedged_calls.inc(stage=stage, outcome=outcome)
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "stages": sorted(self.stages),
+            "credits": round(self.credits, 2),
+            "deadlines": {stage: self.deadline(stage) for stage in sorted(self.latencies)}
+        }
@@ -0,0 +1,306 @@
+# backend/app/utils/job_queue.py
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id              TEXT PRIMARY KEY,
+    kind            TEXT NOT NULL,
+    payload         TEXT NOT NULL,
+    status          TEXT NOT NULL,            -- queued | running | succeeded | failed
+    trace_id        TEXT,
+    idempotency_key TEXT UNIQUE,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    max_attempts    INTEGER NOT NULL,
+    not_before      REAL NOT NULL,            -- earliest time a (re)try may be claimed
+    lease_owner     TEXT,
+    lease_expires   REAL,
+    progress        TEXT,                     -- last stage event seen while running
+    result          TEXT,
+    error           TEXT,
+    created_at      REAL NOT NULL,
+    started_at      REAL,
+    finished_at     REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, not_before, created_at);
+"""
+
+TERMINAL = ("succeeded", "failed")
+COLUMNS = ("id", "kind", "payload", "status", "trace_id", "attempts", "max_attempts", "progress",
+           "result", "error", "created_at", "started_at", "finished_at")
+
+
+class JobFailed(Exception):
+    """Raised by a handler for failures that retrying will not fix."""
+
+
+class JobQueue:
+    """Persistent job queue in SQLite (WAL), shared by every worker process on the host.
+
+    A job is claimed with a single UPDATE ... RETURNING that takes a lease, so
+    two workers can never run it at the same time. Running workers renew the
+    lease; a job whose lease runs out (its worker died) is claimed again by the
+    next free worker, or failed once it has used all its attempts. Results are
+    only accepted from the current lease owner.
+    """
+
+    def __init__(self, db_path: str, lease_seconds: float = 60, max_attempts: int = 3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def enqueue(self, kind: str, payload: dict, trace_id: str = None, idempotency_key: str = None) -> dict:
+        """Add a job, or return the existing one when idempotency_key was used before."""
+        now = time.time()
+        job_id = f"job_{uuid.uuid4().hex}"
+        with self._lock:
+            db = self._db()
+            db.execute(
+                "INSERT INTO jobs (id, kind, payload, status, trace_id, idempotency_key, max_attempts, not_before,"
+                " created_at) VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?) ON CONFLICT(idempotency_key) DO NOTHING",
+                (job_id, kind, json.dumps(payload, ensure_ascii=False), trace_id, idempotency_key,
+                 self.max_attempts, now, now)
+            )
+            if idempotency_key is not None:
+                row = db.execute(f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE idempotency_key = ?",
+                                 (idempotency_key,)).fetchone()
+            else:
+                row = db.execute(f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row)
+
+    def claim(self, worker_id: str):
+        """Atomically take the oldest runnable job (queued, or running with an expired lease)."""
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            # An expired lease that has used up its attempts keeps killing workers: fail it rather than run it again
+            db.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Lease expired after ' || attempts || ' attempts (worker died)',"
+                " finished_at = ?, lease_owner = NULL, lease_expires = NULL"
+                " WHERE status = 'running' AND lease_expires < ? AND attempts >= max_attempts",
+                (now, now)
+            )
+            row = db.execute(
+                "UPDATE jobs SET status = 'running', lease_owner = ?, lease_expires = ?, attempts = attempts + 1,"
+                " started_at = COALESCE(started_at, ?)"
+                " WHERE id = (SELECT id FROM jobs WHERE (status = 'queued' AND not_before <= ?)"
+                "   OR (status = 'running' AND lease_expires < ?) ORDER BY created_at LIMIT 1)"
+                f" RETURNING {', '.join(COLUMNS)}",
+                (worker_id, now + self.lease_seconds, now, now, now)
+            ).fetchone()
+        return self._job(row) if row else None
+
+    def heartbeat(self, job_id: str, worker_id: str, progress: str = None) -> bool:
+        """Extend the lease; False means the lease was lost and the worker must stop."""
+        with self._lock:
+            cursor = self._db().execute(
+                "UPDATE jobs SET lease_expires = ?, progress = COALESCE(?, progress)"
+                " WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, progress, job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, result: dict) -> bool:
+        return self._finish(job_id, worker_id, "succeeded", result=json.dumps(result, ensure_ascii=False))
+
+    def fail(self, job_id: str, worker_id: str, error: str, retry: bool = True) -> bool:
+        """Record a failure: requeued with backoff while attempts remain (and retry is True), else failed."""
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT attempts, max_attempts FROM jobs WHERE id = ? AND lease_owner = ?",
+                             (job_id, worker_id)).fetchone()
+            if row is None:
+                return False
+            attempts, max_attempts = row
+            if retry and attempts < max_attempts:
+                cursor = db.execute(
+                    "UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_expires = NULL, error = ?,"
+                    " not_before = ? WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                    (error, time.time() + 2 ** attempts, job_id, worker_id)
+                )
+                return cursor.rowcount == 1
+        return self._finish(job_id, worker_id, "failed", error=error)
+
+    def release(self, job_id: str, worker_id: str):
+        # Graceful shutdown: hand the job straight back instead of waiting for the lease to expire
+        with self._lock:
+            self._db().execute(
+                "UPDATE jobs SET status = 'queued', lease_owner = NULL, lease_expires = NULL,"
+                " attempts = MAX(attempts - 1, 0) WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (job_id, worker_id)
+            )
+
+    def _finish(self, job_id: str, worker_id: str, status: str, result: str = None, error: str = None) -> bool:
+        with self._lock:
+            cursor = self._db().execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_owner = NULL,"
+                " lease_expires = NULL WHERE id = ? AND lease_owner = ? AND status = 'running'",
+                (status, result, error, time.time(), job_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def get(self, job_id: str):
+        with self._lock:
+            row = self._db().execute(f"SELECT {', '.join(COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def purge(self, older_than_seconds: float) -> int:
+        with self._lock:
+            cursor = self._db().execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND finished_at < ?",
+                (time.time() - older_than_seconds,)
+            )
+        return cursor.rowcount
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._db().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
+
+    @staticmethod
+    def _job(row) -> dict:
+        job = dict(zip(COLUMNS, row))
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+
+# === Workers ===
+class JobWorkerPool:
+    """Runs queued jobs with `concurrency` asyncio workers in this process.
+
+    handler(job, emit) does the work and returns the result dict; emit(event, data)
+    reports progress. Raising JobFailed fails the job for good, any other
+    exception is retried with backoff until max_attempts.
+    """
+
+    def __init__(self, queue: JobQueue, handler, concurrency: int = 2, poll_interval: float = 1.0):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.worker_prefix = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.tasks = []
+        self.running = {}      # job_id -> worker_id
+        self.subscribers = {}  # job_id -> set of asyncio.Queue
+        self._wake = None
+
+    def start(self):
+        if self.tasks:
+            return
+        self._wake = asyncio.Event()
+        self.tasks = [asyncio.create_task(self._worker(f"{self.worker_prefix}:{i}")) for i in range(self.concurrency)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self):
+        # Called after enqueue so an idle worker in this process starts right away
+        if self._wake is not None:
+            self._wake.set()
+
+    # === Progress subscriptions (in-process; other processes are seen by polling the row) ===
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self.subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        listeners = self.subscribers.get(job_id)
+        if listeners is not None:
+            listeners.discard(queue)
+            if not listeners:
+                del self.subscribers[job_id]
+
+    def _publish(self, job_id: str, event: str, data):
+        for queue in self.subscribers.get(job_id, ()):
+            queue.put_nowait((event, data))
+
+    async def _worker(self, worker_id: str):
+        while True:
+            try:
+                job = await asyncio.to_thread(self.queue.claim, worker_id)
+            except sqlite3.Error as e:
+                print(f"Job queue unavailable: {e}")
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run(job, worker_id)
+
+    async def _run(self, job: dict, worker_id: str):
+        job_id = job["id"]
+        self.running[job_id] = worker_id
+        self._publish(job_id, "status", {"status": "running", "attempts": job["attempts"]})
+        work = asyncio.create_task(self.handler(job, lambda event, data: self._progress(job_id, worker_id, event, data)))
+        keeper = asyncio.create_task(self._keep_lease(job_id, worker_id, work))
+        try:
+            result = await work
+        except asyncio.CancelledError:
+            if keeper.done() and not keeper.cancelled() and keeper.result():
+                # Lease lost: another worker owns the job now, so just go back to claiming
+                print(f"Job {job_id}: abandoned after losing the lease")
+                return
+            if not work.done():
+                work.cancel()
+            await asyncio.to_thread(self.queue.release, job_id, worker_id)
+            raise
+        except JobFailed as e:
+            await asyncio.to_thread(self.queue.fail, job_id, worker_id, str(e), False)
+        except Exception as e:
+            print(f"Job {job_id} attempt {job['attempts']} failed: {e}")
+            await asyncio.to_thread(self.queue.fail, job_id, worker_id, f"{type(e).__name__}: {e}", True)
+        else:
+            if not await asyncio.to_thread(self.queue.complete, job_id, worker_id, result):
+                print(f"Job {job_id}: lease lost before completion, result discarded")
+        finally:
+            keeper.cancel()
+            self.running.pop(job_id, None)
+            final = await asyncio.to_thread(self.queue.get, job_id)
+            if final is not None:
+                self._publish(job_id, "status", public_job(final))
+
+    async def _keep_lease(self, job_id: str, worker_id: str, work: asyncio.Task) -> bool:
+        # Returns True once the lease is lost and the work has been cancelled
+        while True:
+            await asyncio.sleep(self.queue.lease_seconds / 3)
+            if not await asyncio.to_thread(self.queue.heartbeat, job_id, worker_id):
+                print(f"Job {job_id}: lease lost, stopping")
+                work.cancel()
+                return True
+
+    async def _progress(self, job_id: str, worker_id: str, event: str, data):
+        self._publish(job_id, event, data)
+        if event != "token":
+            await asyncio.to_thread(self.queue.heartbeat, job_id, worker_id, event)
+
+
+def public_job(job: dict) -> dict:
+    """Job fields safe to return to clients."""
+    return {k: job[k] for k in ("id", "kind", "status", "trace_id", "attempts", "progress",
+                                "result", "error", "created_at", "started_at", "finished_at")}
@@ -0,0 +1,168 @@
+# backend/app/utils/json_patch.py
+import copy
+
+
+class JsonPatchError(ValueError):
+    pass
+
+
+def parse_pointer(path: str) -> list:
+    if path == "":
+        return []
+    if not path.startswith("/"):
+        raise JsonPatchError(f"Invalid JSON pointer: {path!r}")
+    return [part.replace("~1", "/").replace("~0", "~") for part in path[1:].split("/")]
+
+
+def _index(container: list, token: str, allow_end: bool = False) -> int:
+    if allow_end and token == "-":
+        return len(container)
+    if not token.isdigit():
+        raise JsonPatchError(f"Invalid array index: {token!r}")
+    index = int(token)
+    limit = len(container) + (1 if allow_end else 0)
+    if index >= limit:
+        raise JsonPatchError(f"Array index out of range: {index}")
+    return index
+
+
+def _resolve(doc, tokens: list):
+    node = doc
+    for token in tokens:
+        if isinstance(node, dict):
+            if token not in node:
+                raise JsonPatchError(f"Path not found: /{'/'.join(tokens)}")
+            node = node[token]
+        elif isinstance(node, list):
+            node = node[_index(node, token)]
+        else:
+            raise JsonPatchError(f"Cannot traverse into scalar at /{'/'.join(tokens)}")
+    return node
+
+
+def _add(doc, tokens: list, value):
+    if not tokens:
+        return value
+    parent = _resolve(doc, tokens[:-1])
+    last = tokens[-1]
+    if isinstance(parent, dict):
+        parent[last] = value
+    elif isinstance(parent, list):
+        parent.insert(_index(parent, last, allow_end=True), value)
+    else:
+        raise JsonPatchError(f"Cannot add to scalar at /{'/'.join(tokens[:-1])}")
+    return doc
+
+
+def _remove(doc, tokens: list):
+    if not tokens:
+        raise JsonPatchError("Cannot remove the document root")
+    parent = _resolve(doc, tokens[:-1])
+    last = tokens[-1]
+    if isinstance(parent, dict):
+        if last not in parent:
+            raise JsonPatchError(f"Path not found: /{'/'.join(tokens)}")
+        return parent.pop(last)
+    if isinstance(parent, list):
+        return parent.pop(_index(parent, last))
+    raise JsonPatchError(f"Cannot remove from scalar at /{'/'.join(tokens[:-1])}")
+
+
+def apply_patch(doc, patch: list):
+    """Apply an RFC 6902 JSON Patch and return the patched copy; the input is never mutated."""
+    if not isinstance(patch, list):
+        raise JsonPatchError("Patch must be a list of operations")
+
+    result = copy.deepcopy(doc)
+    for i, op in enumerate(patch):
+        if not isinstance(op, dict) or "op" not in op or "path" not in op:
+            raise JsonPatchError(f"Operation {i} must be an object with 'op' and 'path'")
+        kind = op["op"]
+        tokens = parse_pointer(op["path"])
+
+        if kind in ("add", "replace", "test") and "value" not in op:
+            raise JsonPatchError(f"Operation {i} ({kind}) is missing 'value'")
+
+        if kind == "add":
+            result = _add(result, tokens, copy.deepcopy(op["value"]))
+        elif kind == "remove":
+            _remove(result, tokens)
+        elif kind == "replace":
+            if not tokens:
+                result = copy.deepcopy(op["value"])
+            else:
+                _remove(result, tokens)
+                result = _add(result, tokens, copy.deepcopy(op["value"]))
+        elif kind in ("move", "copy"):
+            if "from" not in op:
+                raise JsonPatchError(f"Operation {i} ({kind}) is missing 'from'")
+            source = parse_pointer(op["from"])
+            if kind == "move":
+                if tokens[:len(source)] == source and tokens != source:
+                    raise JsonPatchError(f"Operation {i} moves a value into its own child")
+                value = _remove(result, source)
+            else:
+                value = copy.deepcopy(_resolve(result, source))
+            result = _add(result, tokens, value)
+        elif kind == "test":
+            if _resolve(result, tokens) != op["value"]:
+                raise JsonPatchError(f"Test failed at {op['path']}")
+        else:
+            raise JsonPatchError(f"Unknown operation {kind!r}")
+    return result
+
+
+def _pointer(path: str, token) -> str:
+    return f"{path}/{str(token).replace('~', '~0').replace('/', '~1')}"
+
+
+def _same(a, b) -> bool:
+    # JSON equality: unlike ==, 1 and true, 0 and false, or 1 and 1.0 are different values here
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_same(value, b[key]) for key, value in a.items())
+    if isinstance(a, list):
+        return len(a) == len(b) and all(map(_same, a, b))
+    return a == b
+
+
+def _diff(src, dst, path: str, ops: list):
+    if _same(src, dst):
+        return
+    if isinstance(src, dict) and isinstance(dst, dict):
+        for key in src:
+            if key not in dst:
+                ops.append({"op": "remove", "path": _pointer(path, key)})
+        for key, value in dst.items():
+            if key not in src:
+                ops.append({"op": "add", "path": _pointer(path, key), "value": copy.deepcopy(value)})
+            else:
+                _diff(src[key], value, _pointer(path, key), ops)
+    elif isinstance(src, list) and isinstance(dst, list):
+        # Keep the shared prefix/suffix, diff the overlapping middle pairwise, then trim or extend it
+        prefix = 0
+        while prefix < min(len(src), len(dst)) and _same(src[prefix], dst[prefix]):
+            prefix += 1
+        suffix = 0
+        while (suffix < min(len(src), len(dst)) - prefix
+               and _same(src[len(src) - 1 - suffix], dst[len(dst) - 1 - suffix])):
+            suffix += 1
+        src_mid = src[prefix:len(src) - suffix]
+        dst_mid = dst[prefix:len(dst) - suffix]
+        common = min(len(src_mid), len(dst_mid))
+        for i in range(common):
+            _diff(src_mid[i], dst_mid[i], _pointer(path, prefix + i), ops)
+        for i in reversed(range(common, len(src_mid))):
+            ops.append({"op": "remove", "path": _pointer(path, prefix + i)})
+        for i in range(common, len(dst_mid)):
+            ops.append({"op": "add", "path": _pointer(path, prefix + i), "value": copy.deepcopy(dst_mid[i])})
+    else:
+        ops.append({"op": "replace", "path": path, "value": copy.deepcopy(dst)})
+
+
+def make_patch(src, dst) -> list:
+    """Build an RFC 6902 patch that turns src into dst (apply_patch(src, patch) == dst)."""
+    ops = []
+    _diff(src, dst, "", ops)
+    return ops
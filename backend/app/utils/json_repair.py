@@ -0,0 +1,152 @@
+# backend/app/utils/json_repair.py
+import re
+import json
+
+# How often local repair saved us a round-trip to the LLM
+repair_stats = {"attempts": 0, "repaired": 0, "unrepairable": 0, "retries_avoided": 0}
+
+CLOSERS = {"{": "}", "[": "]"}
+PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+MAX_STARTS = 5  # opening brackets tried before giving up
+_UNPARSED = object()
+
+
+def _scan(text: str, start: int):
+    """Walk text from the opening bracket at `start`, tracking nesting outside strings.
+
+    Returns (end, cut_points, stack, in_string): `end` is the index just past the
+    matching close bracket (None if the text is truncated), and `cut_points` are
+    (index, stack) pairs where everything before index is a sequence of complete
+    top-level elements, so the tail can be dropped and the root closed safely.
+    Only the outermost level is cut: a cut inside a nested value would keep a
+    half-written object that merely happens to parse.
+    """
+    stack, cut_points = [], []
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in CLOSERS:
+            stack.append(ch)
+        elif ch in "}]":
+            if not stack or CLOSERS[stack[-1]] != ch:
+                return None, cut_points, stack, in_string
+            stack.pop()
+            if not stack:
+                return i + 1, cut_points, stack, in_string
+            if len(stack) == 1:
+                cut_points.append((i + 1, list(stack)))
+        elif ch == "," and len(stack) == 1:
+            cut_points.append((i, list(stack)))
+    return None, cut_points, stack, in_string
+
+
+def _fix_syntax(text: str) -> str:
+    # Applied outside string literals only: comments, trailing commas, Python literals
+    out, i, in_string = [], 0, False
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if ch == "\\" and i + 1 < len(text):
+                out.append(text[i + 1])
+                i += 1
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+            out.append(ch)
+        elif text.startswith("//", i):
+            while i < len(text) and text[i] != "\n":
+                i += 1
+            continue
+        else:
+            out.append(ch)
+        i += 1
+    fixed = "".join(out)
+    fixed = re.sub(r",(\s*[}\]])", r"\1", fixed)
+    return re.sub(r'(?<=[:\[,\s])(True|False|None)(?=\s*[,}\]])', lambda m: PY_LITERALS[m.group(1)], fixed)
+
+
+def _close(fragment: str, stack: list) -> str:
+    fragment = re.sub(r"[,\s]+$", "", fragment)
+    return fragment + "".join(CLOSERS[b] for b in reversed(stack))
+
+
+def repair_json(text: str):
+    """Parse LLM output that is almost JSON. Returns (data, repaired) or raises ValueError.
+
+    Handles surrounding prose, trailing commas, comments, Python literals and
+    outputs truncated mid-structure; a truncated tail is cut back to the last
+    complete element rather than guessed at.
+    """
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError as e:
+        original_error = e
+
+    repair_stats["attempts"] += 1
+    # Prose before the JSON can hold brackets of its own ("see [1]: {...}"), so a few later
+    # openings are tried too. An object wins over an array found earlier, but brackets nested
+    # inside a value already parsed, or inside a truncated one, are not tried on their own.
+    fallback, covered, tries = None, 0, 0
+    for match in re.finditer(r"[{\[]", text):
+        start = match.start()
+        if start < covered:
+            continue
+        if tries == MAX_STARTS:
+            break
+        tries += 1
+        end, candidates = _candidates(text, start)
+        if end is None:
+            covered = len(text)  # anything opened inside a truncated value is only part of it
+        data = _first_parsed(candidates)
+        if data is _UNPARSED:
+            continue
+        if isinstance(data, dict):
+            repair_stats["repaired"] += 1
+            return data, True
+        if fallback is None:
+            fallback = (data,)
+        covered = max(covered, end or 0)
+    if fallback is not None:
+        repair_stats["repaired"] += 1
+        return fallback[0], True
+
+    repair_stats["unrepairable"] += 1
+    raise original_error
+
+
+def _candidates(text: str, start: int) -> tuple:
+    """(end, candidates) for the JSON opening at `start`; end is None when the text is truncated."""
+    end, cut_points, stack, in_string = _scan(text, start)
+    if end is not None:
+        return end, [text[start:end]]
+    candidates = []
+    tail = text[start:]
+    # Closing in place is only safe at the top level, when the tail ends on a finished
+    # string or container; a bare number or literal may itself have been cut short
+    if not in_string and len(stack) == 1 and tail.rstrip().endswith(('"', "}", "]")):
+        candidates.append(_close(tail, stack))
+    for index, snapshot in reversed(cut_points[-20:]):
+        candidates.append(_close(text[start:index], snapshot))
+    return None, candidates
+
+
+def _first_parsed(candidates: list):
+    for candidate in candidates:
+        for attempt in (candidate, _fix_syntax(candidate)):
+            try:
+                return json.loads(attempt)
+            except json.JSONDecodeError:
+                continue
+    return _UNPARSED
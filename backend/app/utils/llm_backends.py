@@ -0,0 +1,305 @@
+# backend/app/utils/llm_backends.py
+import os
+import json
+import math
+import random
+import asyncio
+import hashlib
+import threading
+from collections import Counter
+from .output_sizes import STAGE_SECTIONS
+
+# An LLM backend turns a chat request into (content, finish_reason, usage), where usage is
+# {"prompt_tokens", "completion_tokens"} or None. on_token, when given, receives each streamed delta.
+
+
+def _usage(usage) -> dict:
+    if usage is None:
+        return None
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+
+
+class GroqBackend:
+    name = "groq"
+
+    def __init__(self, api_key: str = None):
+        self.api_key = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use so importing the app never needs a key or a connection pool
+        if self._client is None:
+            from groq import AsyncGroq  # imported lazily: the SDK alone is most of the app's import time
+            self._client = AsyncGroq(api_key=self.api_key or os.getenv("GROQ_API_KEY"))
+        return self._client
+
+    async def complete(self, model: str, messages: list, temperature: float, max_tokens: int,
+                       on_token=None, stage: str = None):
+        if on_token is None:
+            completion = await self.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                top_p=1,
+                stream=False
+            )
+            choice = completion.choices[0]
+            return choice.message.content, choice.finish_reason, _usage(completion.usage)
+
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            top_p=1,
+            stream=True
+        )
+        parts, finish_reason, usage = [], None, None
+        async for chunk in stream:
+            # Groq reports usage on the final chunk under x_groq
+            usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                await on_token(delta)
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+        return "".join(parts), finish_reason, _usage(usage)
+
+
+# === Mock backend: canned specs, synthetic latency and injected faults ===
+class MockLLMError(RuntimeError):
+    pass
+
+
+def parse_latency(spec: str):
+    """Build a sampler (seconds) from "fixed:MS", "uniform:LO,HI", "normal:MEAN,STD" or "lognormal:MEDIAN,SIGMA"."""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v.strip()]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(*values) / 1000
+    if kind == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(*values)) / 1000
+    if kind == "lognormal" and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1]) / 1000
+    raise ValueError(f"Invalid latency spec: {spec!r}")
+
+
+def _malform(text: str, rng) -> str:
+    # The first three are salvaged by utils/json_repair.py, the last one forces a retry
+    kind = rng.choice(["truncate", "trailing_comma", "prose", "garbage"])
+    if kind == "truncate":
+        return text[:max(1, int(len(text) * rng.uniform(0.5, 0.95)))]
+    if kind == "trailing_comma":
+        return text[:-1].rstrip() + ",\n}"
+    if kind == "prose":
+        return f"Sure! Here is the JSON you asked for:\n{text}\nLet me know if you need changes."
+    return "I'm sorry, I can't produce that output right now."
+
+
+class MockBackend:
+    """Offline stand-in for the provider, for benchmarks and local runs without a key.
+
+    Answers come from canned specs (schemas/mock_output.json plus any saved
+    specs), chosen deterministically per prompt, so every stage returns data
+    that passes its check unless a fault is injected.
+
+    models gives individual models their own speed/quality profile, e.g.
+    {"llama-3.1-8b-instant": {"latency": "fixed:200", "invalid_rate": 0.3}},
+    with the constructor's latency and *_rate keys; anything unset falls back to those.
+    """
+    name = "mock"
+
+    def __init__(self, mock_path: str, spec_source=None, latency: str = "fixed:0", failure_rate: float = 0.0,
+                 malformed_rate: float = 0.0, invalid_rate: float = 0.0, seed: int = None, stream_chunk: int = 64,
+                 models: dict = None):
+        self.mock_path = mock_path
+        self.spec_source = spec_source  # callable yielding saved specs, loaded on first call
+        defaults = {"latency": latency, "failure_rate": failure_rate, "malformed_rate": malformed_rate,
+                    "invalid_rate": invalid_rate}
+        self.default_profile = self._profile(**defaults)
+        self.profiles = {model: self._profile(**dict(defaults, **profile)) for model, profile in (models or {}).items()}
+        self.stream_chunk = stream_chunk
+        self.rng = random.Random(seed)
+        self.specs = None
+        self.stats = Counter()
+
+    @staticmethod
+    def _profile(latency: str, failure_rate: float = 0.0, malformed_rate: float = 0.0, invalid_rate: float = 0.0):
+        return {"sample_latency": parse_latency(latency), "failure_rate": failure_rate,
+                "malformed_rate": malformed_rate, "invalid_rate": invalid_rate}
+
+    def _load_specs(self):
+        if self.specs is None:
+            with open(self.mock_path, "r", encoding="utf-8") as f:
+                specs = [json.load(f)]
+            if self.spec_source is not None:
+                required = STAGE_SECTIONS["refine"]
+                specs += [s for s in self.spec_source() if isinstance(s, dict) and all(k in s for k in required)]
+            self.specs = specs
+        return self.specs
+
+    def _answer(self, stage: str, prompt: str) -> dict:
+        specs = self._load_specs()
+        spec = specs[int(hashlib.sha1(prompt.encode("utf-8")).hexdigest(), 16) % len(specs)]
+        if stage == "refine_patch":
+            return {"patch": [{"op": "add", "path": "/open_questions/-", "value": "Mock refinement applied?"}]}
+        sections = STAGE_SECTIONS.get(stage, STAGE_SECTIONS["refine"])
+        return {k: spec[k] for k in sections}
+
+    async def complete(self, model: str, messages: list, temperature: float, max_tokens: int,
+                       on_token=None, stage: str = None):
+        prompt = messages[0]["content"]
+        profile = self.profiles.get(model, self.default_profile)
+        self.stats["calls"] += 1
+        self.stats[f"calls:{stage}"] += 1
+        if self.profiles:
+            self.stats[f"model:{model}"] += 1
+        if len(messages) > 1:
+            self.stats["continuations"] += 1
+        elif "\nPrevious:\n" in prompt and "\n\nRetry:\n" in prompt:
+            self.stats["retries"] += 1
+
+        if self.specs is None:
+            await asyncio.to_thread(self._load_specs)  # reads the spec store: keep it off the event loop
+        await asyncio.sleep(profile["sample_latency"](self.rng))
+        if self.rng.random() < profile["failure_rate"]:
+            self.stats["failures_injected"] += 1
+            raise MockLLMError(f"Injected provider failure ({stage})")
+
+        if len(messages) > 1:
+            text = "}"  # continuations are only requested after a truncation the mock never produces
+        else:
+            text = json.dumps(self._answer(stage, prompt), indent=2)
+            if self.rng.random() < profile["invalid_rate"]:
+                self.stats["invalid_injected"] += 1
+                text = '{"note": "the requested sections are missing"}'
+            elif self.rng.random() < profile["malformed_rate"]:
+                self.stats["malformed_injected"] += 1
+                text = _malform(text, self.rng)
+
+        if on_token is not None:
+            for i in range(0, len(text), self.stream_chunk):
+                await on_token(text[i:i + self.stream_chunk])
+        # Rough token counts (~4 chars per token) so usage metrics move under the mock too
+        usage = {"prompt_tokens": sum(len(m["content"]) for m in messages) // 4, "completion_tokens": len(text) // 4}
+        return text, "stop", usage
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        first_attempts = stats.get("calls", 0) - stats.get("retries", 0) - stats.get("continuations", 0)
+        stats["retry_amplification"] = round(stats.get("calls", 0) / first_attempts, 3) if first_attempts else None
+        return stats
+
+    def reset_stats(self):
+        self.stats.clear()
+
+
+# === Cassettes: record every request/response pair, replay them offline ===
+class CassetteMiss(RuntimeError):
+    pass
+
+
+def cassette_key(model: str, messages: list, temperature: float) -> str:
+    # max_tokens is left out on purpose: it adapts to past output sizes (utils/output_sizes.py),
+    # so it can differ between the recording and the replay of the same prompt
+    payload = json.dumps({"model": model, "messages": messages, "temperature": temperature}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CassetteBackend:
+    """Wraps another backend and records to / replays from a JSON Lines cassette.
+
+    mode="record" calls the wrapped backend and appends every answer,
+    mode="replay" never touches the network (a missing entry raises CassetteMiss),
+    mode="auto" replays what it has and records the rest.
+    """
+
+    def __init__(self, inner, path: str, mode: str = "replay"):
+        if mode not in ("record", "replay", "auto"):
+            raise ValueError(f"Invalid cassette mode: {mode!r}")
+        self.inner = inner
+        self.path = path
+        self.mode = mode
+        self.name = f"cassette:{inner.name}"
+        self.entries = {}
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        if mode != "record" and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry["response"]
+
+    async def complete(self, model: str, messages: list, temperature: float, max_tokens: int,
+                       on_token=None, stage: str = None):
+        key = cassette_key(model, messages, temperature)
+        response = self.entries.get(key) if self.mode != "record" else None
+        if response is not None:
+            self.stats["replayed"] += 1
+            if on_token is not None and response["content"]:
+                await on_token(response["content"])
+            return response["content"], response["finish_reason"], response.get("usage")
+        if self.mode == "replay":
+            self.stats["misses"] += 1
+            raise CassetteMiss(f"No cassette entry for this {stage or 'LLM'} request in {self.path}")
+
+        content, finish_reason, usage = await self.inner.complete(
+            model, messages, temperature, max_tokens, on_token=on_token, stage=stage
+        )
+        response = {"content": content, "finish_reason": finish_reason, "usage": usage}
+        self.entries[key] = response
+        self.stats["recorded"] += 1
+        line = json.dumps({"key": key, "stage": stage, "model": model, "messages": messages,
+                           "temperature": temperature, "response": response}, ensure_ascii=False)
+        await asyncio.to_thread(self._append, line)
+        return content, finish_reason, usage
+
+    def _append(self, line: str):
+        # A single O_APPEND write per entry keeps lines whole when several processes record at once
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, (line + "\n").encode("utf-8"))
+            finally:
+                os.close(fd)
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, entries=len(self.entries))
+
+    def reset_stats(self):
+        self.stats.clear()
+
+
+def build_backend(mock_path: str, spec_source=None):
+    """Pick the backend from LLM_BACKEND (groq | mock) and the MOCK_LLM_* settings,
+    wrapped in a cassette when LLM_CASSETTE is set (LLM_CASSETTE_MODE: record | replay | auto)."""
+    backend = _base_backend(mock_path, spec_source)
+    cassette = os.getenv("LLM_CASSETTE")
+    if cassette:
+        return CassetteBackend(backend, cassette, mode=os.getenv("LLM_CASSETTE_MODE", "replay"))
+    return backend
+
+
+def _base_backend(mock_path: str, spec_source=None):
+    if os.getenv("LLM_BACKEND", "groq") == "mock":
+        seed = os.getenv("MOCK_LLM_SEED")
+        return MockBackend(
+            mock_path,
+            spec_source=spec_source,
+            latency=os.getenv("MOCK_LLM_LATENCY", "lognormal:800,0.4"),
+            failure_rate=float(os.getenv("MOCK_LLM_FAILURE_RATE", "0")),
+            malformed_rate=float(os.getenv("MOCK_LLM_MALFORMED_RATE", "0")),
+            invalid_rate=float(os.getenv("MOCK_LLM_INVALID_RATE", "0")),
+            seed=int(seed) if seed else None,
+            models=json.loads(os.getenv("MOCK_LLM_MODELS") or "{}")
+        )
+    return GroqBackend()
@@ -0,0 +1,141 @@
+# backend/app/utils/llm_cache.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def make_cache_key(model: str, prompt: str, temperature: float) -> str:
+    # max_tokens is left out so a learned budget change does not miss every entry; callers check truncation
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    raw = json.dumps([model, prompt_hash, float(temperature)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Two-tier cache for LLM completions: in-memory LRU in front of SQLite on disk."""
+
+    def __init__(self, db_path: str, max_memory_entries: int = 256,
+                 ttl_seconds: int = 7 * 24 * 3600, max_disk_bytes: int = 50 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_memory_entries = max_memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        # Opened lazily so importing the pipeline never touches disk
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache(accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    def _remember(self, key: str, value: str, created_at: float):
+        # Kept with the value so the memory tier expires entries at the same time as the disk
+        self.memory[key] = (value, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key: str):
+        with self._lock:
+            now = time.time()
+            if key in self.memory:
+                value, created_at = self.memory[key]
+                if now - created_at <= self.ttl_seconds:
+                    self.memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return value
+                del self.memory[key]  # expired; the disk lookup below removes its row too
+
+            db = self._db()
+            row = db.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                if row is not None:
+                    db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                    db.commit()
+                self.stats["misses"] += 1
+                return None
+
+            db.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            db.commit()
+            self._remember(key, row[0], row[1])
+            self.stats["disk_hits"] += 1
+            return row[0]
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            now = time.time()
+            self._remember(key, value, now)
+            db = self._db()
+            db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode("utf-8")), now, now)
+            )
+            self.stats["writes"] += 1
+            self._evict(db, now)
+            db.commit()
+
+    def _evict(self, db, now: float):
+        # Expired entries first, then least-recently-used until under the size cap
+        cur = db.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        self.stats["evictions"] += cur.rowcount
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM llm_cache").fetchone()[0]
+        if total <= self.max_disk_bytes:
+            return
+        for key, size in db.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at").fetchall():
+            if total <= self.max_disk_bytes:
+                break
+            db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self.memory.pop(key, None)
+            total -= size
+            self.stats["evictions"] += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self.memory.pop(key, None)
+            db = self._db()
+            db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            db.commit()
+
+    def clear(self):
+        with self._lock:
+            self.memory.clear()
+            db = self._db()
+            db.execute("DELETE FROM llm_cache")
+            db.commit()
+
+    def get_stats(self) -> dict:
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hits": hits,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "memory_entries": len(self.memory),
+        }
+
+
+llm_cache = LLMCache(
+    db_path=os.getenv(
+        "LLM_CACHE_PATH",
+        os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "llm_cache.sqlite3")
+    ),
+    max_memory_entries=int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256")),
+    ttl_seconds=int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    max_disk_bytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(50 * 1024 * 1024))),
+)
@@ -0,0 +1,205 @@
+# backend/app/utils/metrics.py
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Seconds; LLM calls run from sub-second (cache, small stages) to a minute (full refinement)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _label_text(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.values = {}  # sorted label tuple -> value
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_label_text(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.series = {}  # sorted label tuple -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_label_text(key + (('le', '+Inf'),))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {round(series[-2], 6)}")
+                lines.append(f"{self.name}_count{_label_text(key)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Read at scrape time from a callback, for values other modules already track."""
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help = help_text
+        self.read = read  # () -> number, or dict of label tuple -> number
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        value = self.read()
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                lines.append(f"{self.name}{_label_text(key)} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._add(Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, read) -> Gauge:
+        return self._add(Gauge(name, help_text, read))
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# === Pipeline metrics ===
+llm_calls = registry.counter("spec_llm_calls_total", "LLM calls by stage and outcome (ok, cached, error)")
+llm_latency = registry.histogram("spec_llm_call_seconds", "Latency of uncached LLM calls by stage")
+llm_tokens = registry.counter("spec_llm_tokens_total", "Tokens reported by the provider, by stage and kind")
+stage_latency = registry.histogram("spec_stage_seconds", "Wall time of each pipeline stage, retries included")
+stage_retries = registry.counter("spec_stage_retries_total", "Retry attempts by stage")
+stage_failures = registry.counter("spec_stage_failures_total", "Rejected LLM outputs by stage and reason")
+requests_total = registry.counter("spec_requests_total", "Generations and refinements by outcome")
+coalesced = registry.counter("spec_coalesced_requests_total", "Requests served by an identical in-flight computation")
+prompt_tokens = registry.histogram("spec_prompt_tokens", "Estimated input tokens per prompt, by stage",
+                                   buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+prompt_reductions = registry.counter("spec_prompt_reductions_total", "Context trimmed to fit the prompt budget")
+hedged_calls = registry.counter("spec_hedged_calls_total", "Hedged LLM requests by stage and outcome (fired, won, skipped)")
+model_routes = registry.counter("spec_model_routes_total", "Model choices by stage, model and reason (pick, explore, escalate)")
+admission_rejected = registry.counter("spec_admission_rejected_total", "Requests shed by admission control, by lane")
+
+
+# === Per-request breakdown, attached to the trace record ===
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.prompt_versions = {}  # template name -> version used, saved with the trace next to the metrics
+
+    def stage(self, name: str) -> dict:
+        return self.stages.setdefault(name, {
+            "seconds": 0.0, "llm_calls": 0, "cache_hits": 0, "retries": 0,
+            "prompt_tokens": 0, "completion_tokens": 0, "failures": []
+        })
+
+    def as_dict(self) -> dict:
+        stages = {name: dict(s, seconds=round(s["seconds"], 3)) for name, s in self.stages.items()}
+        return {
+            "total_seconds": round(time.perf_counter() - self.started, 3),
+            "llm_calls": sum(s["llm_calls"] for s in stages.values()),
+            "retries": sum(s["retries"] for s in stages.values()),
+            "prompt_tokens": sum(s["prompt_tokens"] for s in stages.values()),
+            "completion_tokens": sum(s["completion_tokens"] for s in stages.values()),
+            "stages": stages
+        }
+
+
+current_request = ContextVar("current_request_metrics", default=None)
+
+
+def _request_stage(stage: str):
+    request = current_request.get()
+    return request.stage(stage or "unknown") if request is not None else None
+
+
+def record_llm_call(stage: str, outcome: str, seconds: float = None, usage: dict = None):
+    stage = stage or "unknown"
+    llm_calls.inc(stage=stage, outcome=outcome)
+    if seconds is not None:
+        llm_latency.observe(seconds, stage=stage)
+    usage = usage or {}
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            llm_tokens.inc(usage[kind], stage=stage, kind=kind.split("_")[0])
+    entry = _request_stage(stage)
+    if entry is not None:
+        entry["llm_calls"] += outcome != "cached"
+        entry["cache_hits"] += outcome == "cached"
+        entry["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        entry["completion_tokens"] += usage.get("completion_tokens") or 0
+
+
+def record_failure(stage: str, reason: str, detail: str = None, retrying: bool = False):
+    stage = stage or "unknown"
+    stage_failures.inc(stage=stage, reason=reason)
+    if retrying:
+        stage_retries.inc(stage=stage)
+    entry = _request_stage(stage)
+    if entry is not None:
+        entry["failures"].append(f"{reason}: {detail}"[:300] if detail else reason)
+        entry["retries"] += retrying
+
+
+@contextmanager
+def timed_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_latency.observe(elapsed, stage=stage)
+        entry = _request_stage(stage)
+        if entry is not None:
+            entry["seconds"] += elapsed
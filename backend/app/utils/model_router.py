@@ -0,0 +1,109 @@
+# backend/app/utils/model_router.py
+import random
+from collections import deque
+from .metrics import model_routes
+
+
+class ModelRouter:
+    """Chooses which model serves each pipeline stage.
+
+    routes maps a stage to its candidate models, cheapest first and strongest
+    last; stages without a route use `default`. Each call is scored from
+    rolling per-(stage, model) measurements of price, median latency and
+    JSON-validity rate, as the expected cost of one usable answer:
+
+        own cost = price of the call + latency_cost * median latency
+        score    = own cost + (1 - validity) * score of the next stronger model
+                   (the strongest model retries itself: own cost / validity)
+
+    and the lowest score wins. Untried models start optimistic (validity prior, no latency) so cheap ones
+    get a chance, and `explore` of the calls go to a random other candidate so
+    a model that recovered is noticed. When an answer fails validation the
+    retry escalates to the next stronger candidate.
+
+    pinned always starts a stage on its first candidate (escalation still
+    applies), so the models called depend only on the answers and not on
+    measured latency: a cassette replay asks for what the recording did.
+    """
+
+    def __init__(self, routes: dict, default: str, prices: dict = None, latency_cost: float = 0.001,
+                 window: int = 100, prior: int = 2, explore: float = 0.05, seed: int = None,
+                 pinned: bool = False):
+        self.routes = {stage: list(models) for stage, models in (routes or {}).items() if models}
+        self.default = default
+        self.prices = prices or {}      # model -> dollars per million tokens
+        self.latency_cost = latency_cost  # dollars we would pay to save one second
+        self.window = window
+        self.prior = prior
+        self.explore = explore
+        self.pinned = pinned
+        self.rng = random.Random(seed)
+        self.samples = {}               # (stage, model) -> {"latency": deque, "valid": deque, "tokens": deque}
+
+    def candidates(self, stage: str) -> list:
+        return self.routes.get(stage) or [self.default]
+
+    def _series(self, stage: str, model: str) -> dict:
+        return self.samples.setdefault((stage, model), {
+            "latency": deque(maxlen=self.window), "valid": deque(maxlen=self.window),
+            "tokens": deque(maxlen=self.window)
+        })
+
+    def record_call(self, stage: str, model: str, seconds: float, tokens: int = None):
+        # Uncached completions only, so cache hits never make a model look fast
+        series = self._series(stage, model)
+        series["latency"].append(seconds)
+        if tokens:
+            series["tokens"].append(tokens)
+
+    def record_validity(self, stage: str, model: str, valid: bool):
+        self._series(stage, model)["valid"].append(valid)
+
+    def score(self, stage: str, model: str) -> float:
+        candidates = self.candidates(stage)
+        # Prompt and answer sizes depend on the stage far more than on the model, so share token counts
+        tokens = [t for m in candidates for t in self._series(stage, m)["tokens"]]
+        avg_tokens = sum(tokens) / len(tokens) if tokens else 1000
+
+        position = candidates.index(model) if model in candidates else len(candidates) - 1
+        series = self._series(stage, model)
+        validity = (sum(series["valid"]) + self.prior) / (len(series["valid"]) + self.prior)
+        latencies = sorted(series["latency"])
+        latency = latencies[len(latencies) // 2] if latencies else 0.0
+        own = self.prices.get(model, 0.0) * avg_tokens / 1_000_000 + self.latency_cost * latency
+        if position == len(candidates) - 1:
+            return own / max(validity, 0.01)
+        return own + (1 - validity) * self.score(stage, candidates[position + 1])
+
+    def pick(self, stage: str) -> str:
+        candidates = self.candidates(stage)
+        if len(candidates) == 1 or self.pinned:
+            return candidates[0]
+        best = min(candidates, key=lambda model: self.score(stage, model))  # ties go to the cheaper model
+        if self.rng.random() < self.explore:
+            best = self.rng.choice([m for m in candidates if m != best])
+            model_routes.inc(stage=stage, model=best, reason="explore")
+        else:
+            model_routes.inc(stage=stage, model=best, reason="pick")
+        return best
+
+    def escalate(self, stage: str, model: str) -> str:
+        """The next stronger candidate after a validation failure (the same model if none is left)."""
+        candidates = self.candidates(stage)
+        position = candidates.index(model) if model in candidates else len(candidates) - 1
+        stronger = candidates[min(position + 1, len(candidates) - 1)]
+        if stronger != model:
+            model_routes.inc(stage=stage, model=stronger, reason="escalate")
+        return stronger
+
+    def get_stats(self) -> dict:
+        stats = {}
+        for (stage, model), series in sorted(self.samples.items()):
+            latencies = sorted(series["latency"])
+            stats.setdefault(stage, {})[model] = {
+                "calls": len(series["latency"]),
+                "validity": round(sum(series["valid"]) / len(series["valid"]), 3) if series["valid"] else None,
+                "p50_seconds": round(latencies[len(latencies) // 2], 3) if latencies else None,
+                "score": round(self.score(stage, model), 6)
+            }
+        return {"routes": self.routes, "default": self.default, "pinned": self.pinned, "stages": stats}
@@ -0,0 +1,64 @@
+# backend/app/utils/output_sizes.py
+import json
+import threading
+from collections import defaultdict, deque
+
+CHARS_PER_TOKEN = 3.5  # JSON-heavy output tokenizes denser than prose
+
+# Spec sections produced by each stage, used to seed sizes from saved specs
+STAGE_SECTIONS = {
+    "features": ["modules", "features_by_module"],
+    "stories": ["user_stories"],
+    "api_endpoints": ["api_endpoints"],
+    "db_schema": ["db_schema"],
+    "open_questions": ["open_questions"],
+    "refine": ["modules", "features_by_module", "user_stories", "api_endpoints", "db_schema", "open_questions"],
+}
+
+
+class OutputSizeTracker:
+    """Learns per-stage completion sizes so max_tokens follows what each stage actually needs."""
+
+    def __init__(self, spec_source, window: int = 200, min_samples: int = 5,
+                 headroom: float = 1.3, floor: int = 512, ceiling: int = 8000):
+        self.spec_source = spec_source  # callable yielding previously saved specs
+        self.window = window
+        self.min_samples = min_samples
+        self.headroom = headroom
+        self.floor = floor
+        self.ceiling = ceiling
+        self.samples = defaultdict(lambda: deque(maxlen=self.window))
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def load(self):
+        # Seed from specs already saved in the store, once. Blocking (it rebuilds up to `limit` specs):
+        # async callers run it with asyncio.to_thread before the first max_tokens()
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            for spec in self.spec_source():
+                self.observe_spec(spec)
+
+    def observe_spec(self, spec):
+        if not isinstance(spec, dict):
+            return
+        for stage, sections in STAGE_SECTIONS.items():
+            if all(k in spec for k in sections):
+                self.record(stage, json.dumps({k: spec[k] for k in sections}, indent=2))
+
+    def record(self, stage: str, output: str):
+        self.samples[stage].append(len(output))
+
+    def max_tokens(self, stage: str, default: int) -> int:
+        sizes = sorted(self.samples.get(stage, ()))
+        if len(sizes) < self.min_samples:
+            return default
+        p95 = sizes[min(len(sizes) - 1, int(len(sizes) * 0.95))]
+        budget = int(p95 / CHARS_PER_TOKEN * self.headroom)
+        return max(self.floor, min(self.ceiling, budget))
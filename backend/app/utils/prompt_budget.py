@@ -0,0 +1,100 @@
+# backend/app/utils/prompt_budget.py
+import re
+import json
+from .prompt_registry import Template
+
+# Rough BPE behaviour: a word costs about one token per 4 letters, numbers one per 3 digits,
+# punctuation one each, and every newline-plus-indent run one more (single spaces merge into
+# the next word). Close enough to budget with, and far cheaper than running a tokenizer.
+_PIECES = re.compile(r"[A-Za-z]+|\d+|\n\s*| {2,}|[^\sA-Za-z\d]")
+
+
+def estimate_tokens(text: str) -> int:
+    tokens = 0
+    for piece in _PIECES.findall(text):
+        if piece[0].isalpha():
+            tokens += (len(piece) + 3) // 4
+        elif piece[0].isdigit():
+            tokens += (len(piece) + 2) // 3
+        else:
+            tokens += 1
+    return tokens
+
+
+def compact_json(value) -> str:
+    """JSON without indentation or spaces after separators; indent=2 costs ~30% more tokens on specs."""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def summarize_text(text: str, target_tokens: int) -> str:
+    """Extractive summary: keep the first sentence of every distinct line, then cut at the target."""
+    lines, seen = [], set()
+    for line in text.strip().splitlines():
+        line = line.strip()
+        if line and line not in seen:
+            seen.add(line)
+            lines.append(re.split(r"(?<=[.!?])\s", line, maxsplit=1)[0])
+    summary = "\n".join(lines)
+    if estimate_tokens(summary) <= target_tokens:
+        return summary
+    return clip_text(summary, target_tokens)
+
+
+def clip_text(text: str, target_tokens: int, marker: str = " [...] ") -> str:
+    """Keep the head and tail of text within roughly target_tokens."""
+    total = estimate_tokens(text)
+    if total <= target_tokens:
+        return text
+    keep = max(0, int(len(text) * target_tokens / total) - len(marker))
+    head = keep * 2 // 3
+    return text[:head] + marker + text[len(text) - (keep - head):] if keep else marker.strip()
+
+
+class PromptSection:
+    """One placeholder of a template.
+
+    reducers are tried in order when the prompt is over budget; each takes
+    (value, target_tokens) and returns a smaller value. Non-string values are
+    serialized with compact_json.
+    """
+
+    def __init__(self, name: str, value, reducers=()):
+        self.name = name
+        self.value = value
+        self.reducers = list(reducers)
+
+    @property
+    def text(self) -> str:
+        return self.value if isinstance(self.value, str) else compact_json(self.value)
+
+
+def fit_prompt(template, sections: list, budget: int):
+    """Render template (a Template or str), shrinking sections until it fits in `budget` estimated tokens.
+
+    Reducers are applied round by round (every section's first reducer, then
+    every section's second, ...), sections ordered least valuable first.
+    Returns (prompt, tokens, reductions) where reductions lists the
+    "section:reducer" steps applied.
+    """
+    if isinstance(template, str):
+        template = Template(template)
+
+    def render():
+        return template.render({section.name: section.text for section in sections})
+
+    prompt = render()
+    tokens = estimate_tokens(prompt)
+    reductions = []
+    while tokens > budget and any(section.reducers for section in sections):
+        for section in sections:
+            if tokens <= budget:
+                break
+            if not section.reducers:
+                continue
+            reducer = section.reducers.pop(0)
+            target = max(0, estimate_tokens(section.text) - (tokens - budget))
+            section.value = reducer(section.value, target)
+            reductions.append(f"{section.name}:{getattr(reducer, '__name__', 'reduce')}")
+            prompt = render()
+            tokens = estimate_tokens(prompt)
+    return prompt, tokens, reductions
@@ -0,0 +1,97 @@
+# backend/app/utils/prompt_registry.py
+import os
+import re
+import time
+import hashlib
+import threading
+
+_PLACEHOLDER = re.compile(r"\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+
+class Template:
+    """A prompt template split once into literal text and {placeholder} slots.
+
+    render() fills every slot in one pass (a join instead of a str.replace
+    per section), and text inserted for one placeholder is never scanned for
+    another. Placeholders without a value are left as written, like the
+    JSON examples in the prompts.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.parts = _PLACEHOLDER.split(text)  # literal, name, literal, name, ..., literal
+        self.names = set(self.parts[1::2])
+
+    def render(self, values: dict) -> str:
+        parts = self.parts[:]
+        for i in range(1, len(parts), 2):
+            name = parts[i]
+            parts[i] = values[name] if name in values else "{" + name + "}"
+        return "".join(parts)
+
+
+class FileRegistry:
+    """Named files parsed on first use and reloaded when they change on disk.
+
+    Each file's mtime is checked at most every `check_interval` seconds
+    (negative: never), so editing a prompt or schema takes effect in running
+    workers without a restart. version(name) is a short hash of the content,
+    recorded with every trace so outputs can be tied to the prompt that made them.
+    """
+
+    def __init__(self, files: dict, parse, check_interval: float = 2.0):
+        self.files = dict(files)  # name -> path
+        self.parse = parse        # file text -> loaded value
+        self.check_interval = check_interval
+        self.entries = {}         # name -> {"value", "version", "mtime", "checked"}
+        self.reloads = 0
+        self._lock = threading.Lock()
+
+    def get(self, name: str):
+        return self._entry(name)["value"]
+
+    def version(self, name: str) -> str:
+        return self._entry(name)["version"]
+
+    def get_versioned(self, name: str) -> tuple:
+        entry = self._entry(name)
+        return entry["value"], entry["version"]
+
+    def versions(self) -> dict:
+        """Versions of the files loaded so far."""
+        return {name: entry["version"] for name, entry in self.entries.items()}
+
+    def _entry(self, name: str) -> dict:
+        entry = self.entries.get(name)
+        now = time.monotonic()
+        if entry is not None and (self.check_interval < 0 or now - entry["checked"] < self.check_interval):
+            return entry
+        with self._lock:
+            entry = self.entries.get(name)
+            path = self.files[name]
+            mtime = os.stat(path).st_mtime_ns
+            if entry is not None and entry["mtime"] == mtime:
+                entry["checked"] = now
+                return entry
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            try:
+                value = self.parse(text)
+            except ValueError as e:
+                if entry is None:
+                    raise
+                # Caught mid-edit: keep serving the last good version and look again next interval
+                print(f"Keeping previous {os.path.basename(path)}, new version does not load: {e}")
+                entry["checked"] = now
+                return entry
+            if entry is not None:
+                self.reloads += 1
+                print(f"Reloaded {os.path.basename(path)}")
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:8]
+            entry = {"value": value, "version": f"{os.path.splitext(os.path.basename(path))[0]}@{digest}",
+                     "mtime": mtime, "checked": now}
+            self.entries[name] = entry
+            return entry
+
+    def get_stats(self) -> dict:
+        return {"loaded": self.versions(), "reloads": self.reloads}
@@ -1,25 +1,133 @@
-from datetime import datetime, timedelta
-from collections import defaultdict
-
-class SimpleRateLimiter:
-    def __init__(self, max_requests: int = 10, per_seconds: int = 60):
-        self.max_requests = max_requests
-        self.per_seconds = per_seconds
-        self.requests = defaultdict(list)
-
-    def is_allowed(self, client_ip: str) -> bool:
-        now = datetime.utcnow()
-        window_start = now - timedelta(seconds=self.per_seconds)
-        
-        # Clean old requests
-        self.requests[client_ip] = [
-            timestamp for timestamp in self.requests[client_ip]
-            if timestamp > window_start
-        ]
-        
-        if len(self.requests[client_ip]) < self.max_requests:
-            self.requests[client_ip].append(now)
-            return True
-        return False
-
-limiter = SimpleRateLimiter(max_requests=10, per_seconds=60)
\ No newline at end of file
+import os
+import time
+import math
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Relative cost of each route in tokens; a full generation is the heaviest call
+ROUTE_COSTS = {
+    "generate": 3,
+    "generate_stream": 3,
+    "refine": 2,
+    "batch": 3,  # per document: a batch costs as much as generating each document on its own
+    "jobs": 3,
+    "resume": 3,
+}
+
+
+def _refill(tokens: float, updated: float, now: float, capacity: float, rate: float) -> float:
+    return min(capacity, tokens + (now - updated) * rate)
+
+
+class MemoryBucketBackend:
+    """Per-process buckets. Keys idle long enough to have refilled are evicted, oldest first."""
+    blocking = False
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, updated); ordered by last use
+        self._lock = threading.Lock()
+
+    def take(self, key: str, cost: float, capacity: float, rate: float, now: float):
+        with self._lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = _refill(tokens, updated, now, capacity, rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self.buckets[key] = (tokens, now)
+            self._evict(now, capacity, rate)
+        return allowed, tokens
+
+    def _evict(self, now: float, capacity: float, rate: float):
+        # A bucket untouched for capacity/rate seconds is full again, so forgetting it changes nothing
+        idle_after = capacity / rate
+        while self.buckets:
+            key, (tokens, updated) = next(iter(self.buckets.items()))
+            if now - updated < idle_after and len(self.buckets) <= self.max_keys:
+                break
+            self.buckets.popitem(last=False)
+
+
+class SQLiteBucketBackend:
+    """Buckets shared by every worker process on the host through a SQLite file."""
+    blocking = True
+
+    def __init__(self, db_path: str, cleanup_every: int = 1000):
+        self.db_path = db_path
+        self.cleanup_every = cleanup_every
+        self._calls = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_buckets_updated ON buckets(updated)")
+            self._conn = conn
+        return self._conn
+
+    def take(self, key: str, cost: float, capacity: float, rate: float, now: float):
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = _refill(*(row or (capacity, now)), now, capacity, rate)
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                db.execute("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens, now))
+                self._calls += 1
+                if self._calls % self.cleanup_every == 0:
+                    db.execute("DELETE FROM buckets WHERE updated < ?", (now - capacity / rate,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return allowed, tokens
+
+
+class TokenBucketLimiter:
+    """O(1) token-bucket limiter: `capacity` tokens per key, refilled continuously at `refill_per_second`."""
+
+    def __init__(self, capacity: float = 30, refill_per_second: float = 0.5, backend=None):
+        self.capacity = capacity
+        self.rate = refill_per_second
+        self.backend = backend or MemoryBucketBackend()
+
+    def check(self, key: str, cost: float = 1):
+        """Returns (allowed, retry_after_seconds); retry_after is 0 when allowed."""
+        if cost <= 0:
+            return True, 0
+        if cost > self.capacity:
+            return False, math.inf
+        allowed, tokens = self.backend.take(key, cost, self.capacity, self.rate, time.time())
+        if allowed:
+            return True, 0
+        return False, math.ceil((cost - tokens) / self.rate)
+
+    def is_allowed(self, key: str, cost: float = 1) -> bool:
+        return self.check(key, cost)[0]
+
+
+def _build_limiter() -> TokenBucketLimiter:
+    # Defaults keep the old budget: 10 generations per minute per client
+    capacity = float(os.getenv("RATE_LIMIT_CAPACITY", "30"))
+    per_minute = float(os.getenv("RATE_LIMIT_REFILL_PER_MINUTE", "30"))
+    if os.getenv("RATE_LIMIT_BACKEND", "memory") == "sqlite":
+        default_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "cache", "rate_limits.sqlite3")
+        backend = SQLiteBucketBackend(os.getenv("RATE_LIMIT_DB_PATH", default_path))
+    else:
+        backend = MemoryBucketBackend()
+    return TokenBucketLimiter(capacity=capacity, refill_per_second=per_minute / 60, backend=backend)
+
+
+limiter = _build_limiter()
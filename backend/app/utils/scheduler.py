@@ -0,0 +1,71 @@
+# backend/app/utils/scheduler.py
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+# Who an LLM call is made on behalf of (the trace ID of the running pipeline)
+llm_owner = ContextVar("llm_owner", default=None)
+
+
+class FairLLMScheduler:
+    """Caps in-flight LLM calls process-wide and hands free slots to waiting owners round-robin.
+
+    Without fairness one large document would queue all its calls ahead of
+    everyone else; here stage 1 of document B gets the next slot while
+    document A's stage 3 sub-calls wait their turn.
+    """
+
+    def __init__(self, max_in_flight: int = 8):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.waiters = OrderedDict()  # owner -> deque of futures, rotated on every grant
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for q in self.waiters.values())
+
+    @asynccontextmanager
+    async def slot(self, owner=None):
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.waiters.setdefault(owner, deque()).append(future)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()  # the slot was handed over just as we were cancelled
+                else:
+                    self._discard(owner, future)
+                raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _discard(self, owner, future):
+        queue = self.waiters.get(owner)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            if not queue:
+                del self.waiters[owner]
+
+    def _release(self):
+        # Transfer the slot straight to the next owner in line instead of freeing it
+        while self.waiters:
+            owner, queue = next(iter(self.waiters.items()))
+            future = queue.popleft()
+            if queue:
+                self.waiters.move_to_end(owner)
+            else:
+                del self.waiters[owner]
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {"max_in_flight": self.max_in_flight, "in_flight": self.in_flight,
+                "queued": self.queued, "waiting_owners": len(self.waiters)}
@@ -0,0 +1,82 @@
+# backend/app/utils/singleflight.py
+import asyncio
+import hashlib
+from collections import Counter
+
+
+def flight_key(*parts) -> str:
+    return hashlib.sha256("\x00".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+def normalize_text(text: str) -> str:
+    # Double-submits and frontend retries differ at most in whitespace
+    return " ".join(text.split())
+
+
+class _Flight:
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.events = []        # everything published so far, replayed to late joiners
+        self.subscribers = []
+        self.lock = asyncio.Lock()
+
+    async def publish(self, event, data):
+        async with self.lock:
+            self.events.append((event, data))
+            for subscriber in list(self.subscribers):
+                try:
+                    await subscriber(event, data)
+                except Exception as e:
+                    print(f"Dropping event subscriber after error: {e}")
+                    self.subscribers.remove(subscriber)
+
+    async def subscribe(self, subscriber):
+        async with self.lock:
+            for event, data in self.events:
+                await subscriber(event, data)
+            self.subscribers.append(subscriber)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one running computation.
+
+    fn(publish) is started by the first caller; publish(event, data) fans events
+    out to every caller's on_event, replaying earlier ones to late joiners.
+    The computation is cancelled only when every caller has gone away.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.stats = Counter()
+
+    async def run(self, key: str, fn, on_event=None):
+        """Returns (result, shared); shared is True when another caller's computation was reused."""
+        flight = self.flights.get(key)
+        shared = flight is not None
+        if not shared:
+            flight = self.flights[key] = _Flight()
+            flight.task = asyncio.ensure_future(fn(flight.publish))
+            flight.task.add_done_callback(lambda _: self._finish(key, flight))
+            self.stats["started"] += 1
+        else:
+            self.stats["coalesced"] += 1
+
+        flight.waiters += 1
+        try:
+            if on_event is not None:
+                await flight.subscribe(on_event)
+            return await asyncio.shield(flight.task), shared
+        finally:
+            flight.waiters -= 1
+            if on_event in flight.subscribers:
+                flight.subscribers.remove(on_event)
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()  # nobody is waiting for this result any more
+
+    def _finish(self, key: str, flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def get_stats(self) -> dict:
+        return dict(self.stats, in_flight=len(self.flights))
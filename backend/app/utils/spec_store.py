@@ -0,0 +1,423 @@
+# backend/app/utils/spec_store.py
+import os
+import re
+import json
+import glob
+import zlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from .json_patch import apply_patch, make_patch
+
+VERSIONS_TABLE = """
+CREATE TABLE IF NOT EXISTS versions (
+    trace_id       TEXT NOT NULL,
+    version        INTEGER NOT NULL,
+    type           TEXT NOT NULL,
+    generated_at   TEXT NOT NULL,
+    parent_version INTEGER,
+    summary        TEXT,
+    meta           TEXT NOT NULL DEFAULT '{}',
+    kind           TEXT NOT NULL,            -- 'snapshot' (full spec) or 'delta' (JSON Patch from previous version)
+    payload        BLOB NOT NULL,            -- zlib-compressed JSON
+    size           INTEGER NOT NULL,         -- uncompressed payload size in bytes
+    PRIMARY KEY (trace_id, version)
+)"""
+
+SCHEMA = VERSIONS_TABLE + """;
+CREATE TABLE IF NOT EXISTS traces (
+    trace_id       TEXT PRIMARY KEY,
+    latest_version INTEGER NOT NULL,
+    created_at     TEXT NOT NULL,
+    updated_at     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_versions_generated_at ON versions(generated_at);
+CREATE TABLE IF NOT EXISTS store_meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    trace_id   TEXT NOT NULL,
+    stage      TEXT NOT NULL,                -- 'input' or a pipeline stage whose output passed its check
+    payload    BLOB NOT NULL,                -- zlib-compressed JSON
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (trace_id, stage)
+);
+"""
+
+SCHEMA_VERSION = 2
+SUMMARY_KEYS = {"initial_generation": "requirements_summary", "refinement": "instruction_summary"}
+
+# A full snapshot is written every SNAPSHOT_INTERVAL versions (or when a delta is
+# not much smaller than the spec), so reconstructing any version replays at most
+# SNAPSHOT_INTERVAL - 1 deltas.
+SNAPSHOT_INTERVAL = int(os.getenv("SPEC_SNAPSHOT_INTERVAL", "8"))
+DELTA_MAX_RATIO = 0.5
+
+
+def _pack(obj) -> tuple:
+    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(raw, 6), len(raw)
+
+
+def _unpack(blob: bytes):
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+class VersionConflict(Exception):
+    pass
+
+
+class SpecNotFound(LookupError):
+    pass
+
+
+class SpecStore:
+    """Versioned spec storage in SQLite (WAL).
+
+    Version numbers are allocated inside a write transaction, so concurrent
+    saves to the same trace (even from different worker processes) never
+    collide. The latest version is a pointer row, so lookups are O(1).
+    Versions are stored as periodic compressed snapshots plus compressed
+    JSON Patch deltas, so a refinement writes O(change) bytes.
+    """
+
+    def __init__(self, db_path: str, legacy_dir: str = None, hot_specs: int = 128):
+        self.db_path = db_path
+        self.legacy_dir = legacy_dir
+        self.hot_specs = hot_specs
+        self._latest = OrderedDict()  # trace_id -> (version, spec JSON); skips reconstruction on the next save
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _db(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._upgrade_schema(conn)
+            conn.executescript(SCHEMA)
+            if self.legacy_dir:
+                self._migrate_legacy(conn, self.legacy_dir)
+            self._conn = conn
+        return self._conn
+
+    # === Writes ===
+    def save_version(self, trace_id: str, spec: dict, entry_type: str, meta: dict = None,
+                     summary: str = None, expected_version: int = None, clear_checkpoints: bool = False,
+                     parent_version: int = None) -> int:
+        """Append a new version and move the latest pointer. Returns the version number.
+
+        expected_version: optional precondition on the current latest version;
+        VersionConflict is raised if another save got there first.
+        clear_checkpoints: drop the trace's stage checkpoints in the same transaction.
+        parent_version: the version this one was derived from, when not the current latest
+        (a refinement of an older version). The stored delta is still against the latest.
+        """
+        now = datetime.now().isoformat()
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                row = db.execute("SELECT latest_version FROM traces WHERE trace_id = ?", (trace_id,)).fetchone()
+                current = row[0] if row else 0
+                if expected_version is not None and current != expected_version:
+                    raise VersionConflict(f"{trace_id} is at v{current}, expected v{expected_version}")
+                version = current + 1
+                kind, payload, size = self._encode(db, trace_id, current, spec)
+                db.execute(
+                    "INSERT INTO versions (trace_id, version, type, generated_at, parent_version, summary, meta,"
+                    " kind, payload, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (trace_id, version, entry_type, now, parent_version or current or None, summary,
+                     json.dumps(meta or {}, ensure_ascii=False), kind, payload, size)
+                )
+                db.execute(
+                    "INSERT INTO traces (trace_id, latest_version, created_at, updated_at) VALUES (?, ?, ?, ?)"
+                    " ON CONFLICT(trace_id) DO UPDATE SET latest_version = excluded.latest_version,"
+                    " updated_at = excluded.updated_at",
+                    (trace_id, version, now, now)
+                )
+                if clear_checkpoints:
+                    db.execute("DELETE FROM checkpoints WHERE trace_id = ?", (trace_id,))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            self._remember(trace_id, version, spec)
+        return version
+
+    def _encode(self, db, trace_id: str, previous_version: int, spec: dict) -> tuple:
+        # Returns (kind, compressed payload, uncompressed size) for the version after previous_version
+        if previous_version == 0 or previous_version % SNAPSHOT_INTERVAL == 0:
+            return ("snapshot", *_pack(spec))
+        previous = self._spec_at(db, trace_id, previous_version)
+        delta, delta_size = _pack(make_patch(previous, spec))
+        snapshot, snapshot_size = _pack(spec)
+        if delta_size > snapshot_size * DELTA_MAX_RATIO:
+            return "snapshot", snapshot, snapshot_size
+        return "delta", delta, delta_size
+
+    def _remember(self, trace_id: str, version: int, spec: dict):
+        # Kept serialized so callers mutating their copy can never corrupt the next delta
+        self._latest[trace_id] = (version, json.dumps(spec, ensure_ascii=False))
+        self._latest.move_to_end(trace_id)
+        while len(self._latest) > self.hot_specs:
+            self._latest.popitem(last=False)
+
+    def _spec_at(self, db, trace_id: str, version: int):
+        # Rebuild a version from the nearest snapshot at or before it
+        hot = self._latest.get(trace_id)
+        if hot and hot[0] == version:
+            self._latest.move_to_end(trace_id)
+            return json.loads(hot[1])
+        rows = db.execute(
+            "SELECT kind, payload FROM versions WHERE trace_id = ? AND version <= ? AND version >= ("
+            " SELECT MAX(version) FROM versions WHERE trace_id = ? AND version <= ? AND kind = 'snapshot')"
+            " ORDER BY version", (trace_id, version, trace_id, version)
+        ).fetchall()
+        if not rows:
+            return None
+        spec = None
+        for kind, payload in rows:
+            spec = _unpack(payload) if kind == "snapshot" else apply_patch(spec, _unpack(payload))
+        return spec
+
+    # === Stage checkpoints: validated stage outputs of a generation that has not been saved yet ===
+    def save_checkpoint(self, trace_id: str, stage: str, data):
+        payload, _ = _pack(data)
+        with self._lock:
+            self._db().execute(
+                "INSERT OR REPLACE INTO checkpoints (trace_id, stage, payload, created_at) VALUES (?, ?, ?, ?)",
+                (trace_id, stage, payload, datetime.now().isoformat())
+            )
+
+    def get_checkpoints(self, trace_id: str) -> dict:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT stage, payload FROM checkpoints WHERE trace_id = ?", (trace_id,)
+            ).fetchall()
+        return {stage: _unpack(payload) for stage, payload in rows}
+
+    def purge_checkpoints(self, older_than_seconds: float) -> int:
+        cutoff = datetime.fromtimestamp(datetime.now().timestamp() - older_than_seconds).isoformat()
+        with self._lock:
+            # Whole traces only, so a resume never finds later stages without the input
+            cursor = self._db().execute(
+                "DELETE FROM checkpoints WHERE trace_id IN ("
+                " SELECT trace_id FROM checkpoints GROUP BY trace_id HAVING MAX(created_at) < ?)", (cutoff,)
+            )
+        return cursor.rowcount
+
+    # === Reads ===
+    META_COLUMNS = "trace_id, version, type, generated_at, parent_version, summary, meta"
+
+    def _record(self, db, row) -> dict:
+        trace_id, version, entry_type, generated_at, parent_version, summary, meta = row
+        record = {"version": version, "generated_at": generated_at, "trace_id": trace_id, "type": entry_type}
+        if parent_version is not None:
+            record["parent_version"] = parent_version
+        record.update(json.loads(meta))
+        record["spec"] = self._spec_at(db, trace_id, version)
+        return record
+
+    def get_version(self, trace_id: str, version: int):
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                f"SELECT {self.META_COLUMNS} FROM versions WHERE trace_id = ? AND version = ?", (trace_id, version)
+            ).fetchone()
+            return self._record(db, row) if row else None
+
+    def get_latest(self, trace_id: str):
+        with self._lock:
+            db = self._db()
+            row = db.execute(
+                f"SELECT {', '.join('v.' + c for c in self.META_COLUMNS.split(', '))}"
+                " FROM traces t JOIN versions v ON v.trace_id = t.trace_id AND v.version = t.latest_version"
+                " WHERE t.trace_id = ?", (trace_id,)
+            ).fetchone()
+            return self._record(db, row) if row else None
+
+    def get_spec(self, trace_id: str, version: int = None) -> tuple:
+        """(version, spec) of the given or latest version, without the record metadata; (0, None) if unknown.
+
+        The latest spec of recently used traces is served from the in-memory LRU;
+        only the O(1) pointer lookup touches the database.
+        """
+        with self._lock:
+            db = self._db()
+            row = db.execute("SELECT latest_version FROM traces WHERE trace_id = ?", (trace_id,)).fetchone()
+            if row is None:
+                return 0, None
+            latest = row[0]
+            version = latest if version is None else version
+            spec = self._spec_at(db, trace_id, version)
+            if spec is None:
+                return 0, None
+            if version == latest and self._latest.get(trace_id, (0,))[0] != version:
+                self._remember(trace_id, version, spec)  # rebuilt from disk; keep it hot for the next refinement
+            return version, spec
+
+    def latest_version(self, trace_id: str) -> int:
+        with self._lock:
+            row = self._db().execute("SELECT latest_version FROM traces WHERE trace_id = ?", (trace_id,)).fetchone()
+        return row[0] if row else 0
+
+    def get_history(self, trace_id: str) -> list:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT version, generated_at, type, summary, parent_version FROM versions WHERE trace_id = ?"
+                " ORDER BY version",
+                (trace_id,)
+            ).fetchall()
+        history = []
+        for version, generated_at, entry_type, summary, parent_version in rows:
+            entry = {"version": version, "generated_at": generated_at, "type": entry_type}
+            if parent_version is not None:
+                entry["parent_version"] = parent_version
+            if summary is not None:
+                entry[SUMMARY_KEYS.get(entry_type, "summary")] = summary
+            history.append(entry)
+        return history
+
+    def list_traces(self, limit: int = 50, offset: int = 0) -> list:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT trace_id, latest_version, created_at, updated_at FROM traces"
+                " ORDER BY updated_at DESC LIMIT ? OFFSET ?", (limit, offset)
+            ).fetchall()
+        return [dict(zip(("trace_id", "latest_version", "created_at", "updated_at"), r)) for r in rows]
+
+    def iter_specs(self, limit: int = 500):
+        # Latest spec of the most recently updated traces; used to seed per-stage output size estimates
+        with self._lock:
+            db = self._db()
+            rows = db.execute(
+                "SELECT trace_id, latest_version FROM traces ORDER BY updated_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+            specs = [self._spec_at(db, trace_id, version) for trace_id, version in rows]
+        yield from (spec for spec in specs if spec is not None)
+
+    def storage_stats(self) -> dict:
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT kind, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(payload)), 0)"
+                " FROM versions GROUP BY kind"
+            ).fetchall()
+        return {kind: {"count": count, "raw_bytes": raw, "stored_bytes": stored} for kind, count, raw, stored in rows}
+
+    # === Schema upgrades ===
+    def _upgrade_schema(self, db):
+        # v1 (first SQLite layout) kept a full JSON copy of every version in versions.spec
+        version = db.execute("PRAGMA user_version").fetchone()[0]
+        columns = [r[1] for r in db.execute("PRAGMA table_info(versions)").fetchall()]
+        if version >= SCHEMA_VERSION or not columns:
+            db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            return
+        if "spec" in columns:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(
+                    "SELECT trace_id, version, type, generated_at, parent_version, summary, meta, spec"
+                    " FROM versions ORDER BY trace_id, version"
+                ).fetchall()
+                db.execute("DROP INDEX IF EXISTS idx_versions_generated_at")
+                db.execute("ALTER TABLE versions RENAME TO versions_v1")
+                db.execute(VERSIONS_TABLE)
+                for row in rows:
+                    self._insert_full(db, *row[:7], json.loads(row[7]))
+                db.execute("DROP TABLE versions_v1")
+                db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            print(f"Spec store: converted {len(rows)} versions to snapshot + delta storage")
+
+    def _insert_full(self, db, trace_id, version, entry_type, generated_at, parent_version, summary, meta, spec):
+        # Bulk path for imports: versions must arrive in order per trace
+        kind, payload, size = self._encode(db, trace_id, version - 1, spec)
+        db.execute(
+            "INSERT OR IGNORE INTO versions (trace_id, version, type, generated_at, parent_version, summary, meta,"
+            " kind, payload, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (trace_id, version, entry_type, generated_at, parent_version, summary, meta, kind, payload, size)
+        )
+        self._remember(trace_id, version, spec)
+
+    # === Migration from backend/app/logs/trace_* directories ===
+    def _migrate_legacy(self, db, logs_dir: str):
+        imported = 0
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Checked inside the write lock so only one worker process imports
+            if db.execute("SELECT 1 FROM store_meta WHERE key = 'legacy_imported'").fetchone():
+                db.execute("ROLLBACK")
+                return
+            for trace_dir in sorted(glob.glob(os.path.join(logs_dir, "trace_*"))):
+                if os.path.isdir(trace_dir):
+                    imported += self._import_trace_dir(db, trace_dir)
+            # Oldest format: a single spec per file, e.g. logs/trace_<ts>_<id>.json or refine_<ts>_<id>.json
+            for path in sorted(glob.glob(os.path.join(logs_dir, "*.json"))):
+                imported += self._import_single_file(db, path)
+            db.execute("INSERT INTO store_meta (key, value) VALUES ('legacy_imported', ?)", (datetime.now().isoformat(),))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if imported:
+            print(f"Spec store: imported {imported} legacy versions from {logs_dir}")
+
+    @staticmethod
+    def _load_json(path: str):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _import_trace_dir(self, db, trace_dir: str) -> int:
+        trace_id = os.path.basename(trace_dir)
+        history = {h.get("version"): h for h in self._load_json(os.path.join(trace_dir, "history.json")) or []}
+        versions = []
+        for path in glob.glob(os.path.join(trace_dir, "v*.json")):
+            match = re.fullmatch(r"v(\d+)\.json", os.path.basename(path))
+            record = self._load_json(path) if match else None
+            if isinstance(record, dict) and isinstance(record.get("spec"), dict):
+                versions.append((int(match.group(1)), record))
+        if not versions:
+            return 0
+
+        for version, record in sorted(versions, key=lambda v: v[0]):
+            entry_type = record.get("type", "initial_generation")
+            entry = history.get(version, {})
+            summary = entry.get(SUMMARY_KEYS.get(entry_type, "summary"))
+            meta = {k: v for k, v in record.items()
+                    if k not in ("version", "generated_at", "trace_id", "type", "parent_version", "spec")}
+            self._insert_full(
+                db, trace_id, version, entry_type, record.get("generated_at") or entry.get("generated_at", ""),
+                record.get("parent_version"), summary, json.dumps(meta, ensure_ascii=False), record["spec"]
+            )
+        latest = max(v for v, _ in versions)
+        generated = [r.get("generated_at", "") for _, r in versions]
+        db.execute(
+            "INSERT OR IGNORE INTO traces (trace_id, latest_version, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            (trace_id, latest, min(generated), max(generated))
+        )
+        return len(versions)
+
+    def _import_single_file(self, db, path: str) -> int:
+        spec = self._load_json(path)
+        if not isinstance(spec, dict) or "modules" not in spec:
+            return 0
+        trace_id = os.path.splitext(os.path.basename(path))[0]
+        match = re.search(r"_(\d{8}_\d{6})_", trace_id)
+        generated_at = datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").isoformat() if match else ""
+        entry_type = "refinement" if trace_id.startswith("refine_") else "initial_generation"
+        self._insert_full(db, trace_id, 1, entry_type, generated_at, None, None, "{}", spec)
+        db.execute(
+            "INSERT OR IGNORE INTO traces (trace_id, latest_version, created_at, updated_at) VALUES (?, 1, ?, ?)",
+            (trace_id, generated_at, generated_at)
+        )
+        return 1
@@ -0,0 +1,95 @@
+# backend/app/utils/spec_validation.py
+import threading
+
+# Spec sections each stage produces; a stage's output is checked against just these parts of the schema
+STAGE_KEYS = {
+    "features": ["modules", "features_by_module"],
+    "stories": ["user_stories"],
+    "api_endpoints": ["api_endpoints"],
+    "db_schema": ["db_schema"],
+    "open_questions": ["open_questions"],
+}
+MAX_REPORTED_ERRORS = 10
+
+
+class SchemaViolation(ValueError):
+    """Stage output that parsed and has the right keys but breaks the schema.
+
+    The message lists every error (fed back into the retry prompt); usable is
+    the output itself when its sections at least have the right types, kept as
+    a last resort if the retries do no better.
+    """
+
+    def __init__(self, errors: list, usable=None):
+        super().__init__("Schema errors: " + "; ".join(errors))
+        self.errors = errors
+        self.usable = usable
+
+
+class SpecValidator:
+    """Draft-7 validators for the full spec and each stage's slice of it.
+
+    Validators are built once per schema version (the schema is checked
+    once, not on every call) and rebuilt only when schema_source() returns
+    a new version, e.g. after a hot reload of output_schema.json.
+    """
+
+    def __init__(self, schema_source):
+        self.schema_source = schema_source  # () -> (schema dict, version)
+        self.version = None
+        self.validators = {}
+        self._lock = threading.Lock()
+
+    def _validators(self) -> dict:
+        schema, version = self.schema_source()
+        if version != self.version:
+            with self._lock:
+                if version != self.version:
+                    self.validators = self._compile(schema)
+                    self.version = version
+        return self.validators
+
+    @staticmethod
+    def _compile(schema: dict) -> dict:
+        from jsonschema import Draft7Validator  # imported on first validation to keep startup fast
+        Draft7Validator.check_schema(schema)
+        validators = {"spec": Draft7Validator(schema)}
+        for stage, keys in STAGE_KEYS.items():
+            properties = {key: schema["properties"][key] for key in keys}
+            validators[stage] = Draft7Validator({"type": "object", "properties": properties, "required": keys})
+            # Just the top-level types: enough for the rest of the pipeline to work with the output
+            validators[f"{stage}:shape"] = Draft7Validator({
+                "type": "object", "properties": {key: {"type": p["type"]} for key, p in properties.items()}
+            })
+        return validators
+
+    def errors(self, stage: str, data) -> list:
+        """Every schema error for `stage` ("spec" for the whole spec), as "at /path: message" lines."""
+        validator = self._validators()[stage]
+        if validator.is_valid(data):
+            return []
+        errors = list(validator.iter_errors(data))
+        lines = [f"at /{'/'.join(str(p) for p in e.absolute_path)}: {e.message}"[:300]
+                 for e in errors[:MAX_REPORTED_ERRORS]]
+        if len(errors) > MAX_REPORTED_ERRORS:
+            lines.append(f"... and {len(errors) - MAX_REPORTED_ERRORS} more")
+        return lines
+
+    def check_stage(self, stage: str, data, unwrap: bool = False):
+        """The stage's sections of data (extra keys dropped), or SchemaViolation listing what is wrong.
+
+        unwrap returns the value itself for single-section stages (the list of user stories).
+        """
+        if not isinstance(data, dict):
+            raise ValueError("Expected a JSON object")
+        keys = STAGE_KEYS[stage]
+        missing = [key for key in keys if key not in data]
+        if missing:
+            raise ValueError(f"Missing keys: {', '.join(missing)}")
+        section = {key: data[key] for key in keys}
+        result = section[keys[0]] if unwrap else section
+        errors = self.errors(stage, section)
+        if errors:
+            usable = result if self._validators()[f"{stage}:shape"].is_valid(section) else None
+            raise SchemaViolation(errors, usable=usable)
+        return result
@@ -0,0 +1,51 @@
+# backend/tests/test_spec_deltas.py
+# Run from backend/: python -m pytest -q tests
+import json
+import pytest
+from app.utils.json_patch import apply_patch, make_patch
+from app.utils.spec_store import SpecStore
+
+CASES = [
+    ({"a": 1}, {"a": True}),
+    ({"a": 0}, {"a": False}),
+    ({"a": 1}, {"a": 1.0}),
+    ({"a": True}, {"a": 1}),
+    ([0, 1], [False, True]),
+    ([1, 2, 3], [1, 2.0, 3]),
+    ({"a": {"b": [1, {"c": 0}]}}, {"a": {"b": [1, {"c": False}]}}),
+    ({"a": None}, {"a": 0}),
+    ({"a": "1"}, {"a": 1}),
+    ({"x": [1, 2, 3]}, {"x": [3, 2]}),
+    ({"~k/": 1}, {"~k/": 2, "new": [True]}),
+]
+
+
+def typed(value):
+    # Type-exact view of a JSON value, so 1 and True or 1 and 1.0 never compare equal
+    return json.dumps(value, sort_keys=True)
+
+
+@pytest.mark.parametrize("src,dst", CASES)
+def test_patch_round_trip_keeps_types(src, dst):
+    patch = make_patch(src, dst)
+    assert patch, "a change of JSON type must produce a patch"
+    assert typed(apply_patch(src, patch)) == typed(dst)
+
+
+def test_identical_documents_give_empty_patch():
+    assert make_patch({"a": [1, True, 1.5, None]}, {"a": [1, True, 1.5, None]}) == []
+
+
+def test_store_reads_back_delta_versions_with_their_types(tmp_path):
+    db_path = str(tmp_path / "specs.sqlite3")
+    base = {"api_endpoints": [{"path": "/tasks", "auth_required": 1}],
+            "db_schema": [{"name": "done", "default": 0}]}
+    changed = {"api_endpoints": [{"path": "/tasks", "auth_required": True}],
+               "db_schema": [{"name": "done", "default": False}]}
+    store = SpecStore(db_path)
+    store.save_version("trace_t", base, "initial_generation")
+    store.save_version("trace_t", changed, "refinement")
+
+    cold = SpecStore(db_path)  # no hot copy: v2 is rebuilt from the v1 snapshot and its delta
+    assert typed(cold.get_spec("trace_t", 2)[1]) == typed(changed)
+    assert typed(cold.get_spec("trace_t", 1)[1]) == typed(base)
@@ -26,7 +26,13 @@ export default function Home() {
     setTraceId('');
 
     try {
-      const result = await api.generateSpec(input);
+      // Render each section as soon as its pipeline stage finishes
+      const result = await api.generateSpecStream(input, (event, data) => {
+        if (event === 'started') setTraceId(data.trace_id);
+        if (['features', 'stories', 'api_db'].includes(event)) {
+          setSpec((prev) => ({ ...(prev || {}), ...data }));
+        }
+      });
       setSpec(result.spec);
       setTraceId(result.trace_id);
     } catch (err) {
@@ -48,7 +54,7 @@ export default function Home() {
     setError('');
 
     try {
-      const result = await api.refineSpec(spec, refinementText, traceId);
+      const result = await api.refineSpec(refinementText, traceId);
       setSpec(result.spec);
     } catch (err) {
       console.error('Refinement error:', err);
@@ -95,12 +101,14 @@ export default function Home() {
                 <OutputTabs spec={spec} />
               </div>
 
-              <div className="mt-16">
-                <RefinementPanel
-                  onRefine={handleRefine}
-                  isRefining={refining}
-                />
-              </div>
+              {!loading && (
+                <div className="mt-16">
+                  <RefinementPanel
+                    onRefine={handleRefine}
+                    isRefining={refining}
+                  />
+                </div>
+              )}
             </>
           )}
         </div>
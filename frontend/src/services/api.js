@@ -27,14 +27,61 @@ const apiService = {
     return response.data;
   },
 
-  refineSpec: async (spec, refinementText, traceId) => {
+  // Streams pipeline stages over SSE; onEvent(event, data) fires as each stage completes
+  generateSpecStream: async (input, onEvent) => {
+    if (!isDev && !backendUrl) {
+      throw new Error(
+        'Backend is not configured yet. This is a frontend demo — generation is disabled until the backend is deployed.'
+      );
+    }
+    const baseURL = isDev ? '/specs' : `${backendUrl}/specs`;
+    const response = await fetch(`${baseURL}/generate/stream`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ requirements_text: input.trim() }),
+    });
+    if (!response.ok) {
+      const body = await response.json().catch(() => ({}));
+      throw new Error(body.detail || `Generation failed (${response.status})`);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let result = null;
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const raw = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+        const event = raw.match(/^event: (.*)$/m)?.[1];
+        const data = raw.match(/^data: (.*)$/m)?.[1];
+        if (!event || data === undefined) continue;
+
+        const parsed = JSON.parse(data);
+        if (event === 'error') throw new Error(parsed.detail || 'Generation failed — please try again.');
+        if (event === 'complete') result = { trace_id: parsed.trace_id, spec: parsed.spec };
+        onEvent?.(event, parsed);
+      }
+    }
+
+    if (!result) throw new Error('Generation stream ended unexpectedly — please try again.');
+    return result;
+  },
+
+  refineSpec: async (refinementText, traceId) => {
     if (!isDev && !backendUrl) {
       throw new Error(
         'Backend is not configured yet. Refinement is disabled in demo mode.'
       );
     }
+    // The backend refines its stored copy of the spec, so only the trace ID is sent
     const response = await api.post('/refine', {
-      current_spec: spec,
       refinement_text: refinementText.trim(),
       trace_id: traceId,
     });
@@ -0,0 +1,159 @@
+"""Offline benchmark for the spec pipeline, run against the mock LLM backend.
+
+Measures throughput, p50/p95/p99 latency and retry amplification
+(LLM calls made / LLM calls needed) for run_pipeline, run_refinement and the
+HTTP endpoints at several concurrency levels, without spending Groq tokens.
+
+Run from the project root:
+    python scripts/benchmark.py --concurrency 1,8,32 --requests 64 --latency lognormal:800,0.4
+    python scripts/benchmark.py --targets http --malformed-rate 0.2 --failure-rate 0.02
+"""
+import os
+import sys
+import json
+import time
+import glob
+import asyncio
+import argparse
+import tempfile
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--targets", default="pipeline,refine,http", help="comma list of pipeline, refine, http")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma list of concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="requests per concurrency level")
+    parser.add_argument("--latency", default="lognormal:800,0.4", help="mock latency per LLM call (see parse_latency)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of LLM calls that raise")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="share of LLM replies with broken JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    return parser.parse_args()
+
+
+def configure_env(args, workdir):
+    # Must run before the app is imported: the backend, store and limiter are built at import time
+    os.environ["LLM_BACKEND"] = "mock"
+    os.environ["MOCK_LLM_LATENCY"] = args.latency
+    os.environ["MOCK_LLM_FAILURE_RATE"] = str(args.failure_rate)
+    os.environ["MOCK_LLM_MALFORMED_RATE"] = str(args.malformed_rate)
+    os.environ["MOCK_LLM_SEED"] = str(args.seed)
+    os.environ["SPEC_STORE_PATH"] = os.path.join(workdir, "specs.sqlite3")
+    os.environ["LLM_CACHE_PATH"] = os.path.join(workdir, "llm_cache.sqlite3")
+    os.environ["RATE_LIMIT_CAPACITY"] = "1000000"
+    os.environ["RATE_LIMIT_REFILL_PER_MINUTE"] = "1000000"
+    os.environ.setdefault("GROQ_API_KEY", "offline-benchmark")
+
+
+def load_samples():
+    samples = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "samples", "*.txt"))):
+        with open(path, "r", encoding="utf-8") as f:
+            samples.append(f.read())
+    return samples
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+async def run_level(make_call, count, concurrency):
+    """Run `count` calls with at most `concurrency` in flight; returns (latencies, errors, wall_seconds)."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                ok = await make_call(i)
+            except Exception:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    return sorted(latencies), errors, time.perf_counter() - start
+
+
+async def main(args):
+    import httpx
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        from app import pipeline
+        from app.main import app
+
+    samples = load_samples()
+    with open(os.path.join(ROOT, "backend", "app", "schemas", "mock_output.json"), "r", encoding="utf-8") as f:
+        base_spec = json.load(f)
+
+    # Every call bypasses the LLM cache so each request pays for its LLM calls
+    async def call_pipeline(i):
+        spec, _ = await pipeline.run_pipeline(f"{samples[i % len(samples)]}\n(benchmark request {i})", use_cache=False)
+        return spec is not None
+
+    async def call_refine(i):
+        spec, _ = await pipeline.run_refinement(base_spec, f"Benchmark refinement {i}: require auth everywhere",
+                                                f"bench_refine_{i}", use_cache=False)
+        return spec is not None
+
+    http = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=None)
+
+    async def call_http(i):
+        response = await http.post("/specs/generate", json={
+            "requirements_text": f"{samples[i % len(samples)]}\n(benchmark request {i})",
+            "bypass_cache": True
+        })
+        return response.status_code == 200
+
+    calls = {"pipeline": call_pipeline, "refine": call_refine, "http": call_http}
+    results = []
+    print(f"Mock latency {args.latency}, failure rate {args.failure_rate}, malformed rate {args.malformed_rate}, "
+          f"LLM_MAX_IN_FLIGHT={pipeline.llm_scheduler.max_in_flight}\n")
+    print(f"{'target':<10}{'conc':>6}{'reqs':>6}{'err':>5}{'req/s':>9}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}"
+          f"{'llm calls':>11}{'retry amp':>11}")
+
+    try:
+        for target in [t.strip() for t in args.targets.split(",") if t.strip()]:
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                pipeline.llm_backend.reset_stats()
+                with contextlib.redirect_stdout(open(os.devnull, "w")):  # mute the per-stage pipeline logging
+                    latencies, errors, wall = await run_level(calls[target], args.requests, concurrency)
+                llm = pipeline.llm_backend.get_stats()
+                row = {
+                    "target": target,
+                    "concurrency": concurrency,
+                    "requests": args.requests,
+                    "errors": errors,
+                    "throughput_rps": round(args.requests / wall, 3),
+                    "p50_s": round(percentile(latencies, 50), 3),
+                    "p95_s": round(percentile(latencies, 95), 3),
+                    "p99_s": round(percentile(latencies, 99), 3),
+                    "llm": llm
+                }
+                results.append(row)
+                print(f"{target:<10}{concurrency:>6}{args.requests:>6}{errors:>5}{row['throughput_rps']:>9}"
+                      f"{row['p50_s']:>9}{row['p95_s']:>9}{row['p99_s']:>9}"
+                      f"{llm.get('calls', 0):>11}{str(llm.get('retry_amplification')):>11}")
+    finally:
+        await http.aclose()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+        print(f"\nResults saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="spec_benchmark_") as workdir:
+        configure_env(args, workdir)
+        asyncio.run(main(args))
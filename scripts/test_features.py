@@ -1,125 +1,198 @@
+"""Regression harness: runs every samples/*.txt through the full pipeline in parallel.
+
+LLM traffic goes through a cassette (see backend/app/utils/llm_backends.py):
+    python scripts/test_features.py --mode record    # live Groq run, every request/response is saved
+    python scripts/test_features.py                  # replay offline at memory speed (default)
+    python scripts/test_features.py --mode live      # live run, nothing recorded
+Add --mock to use the offline mock backend instead of Groq (handy for trying the harness itself).
+
+Each sample reports success, schema validity and per-stage latency, and is
+compared against a saved baseline (--save-baseline stores the current run).
+"""
 import os
+import sys
 import json
 import glob
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dotenv import load_dotenv
-from groq import Groq
-
-# Load environment variables from .env at project root
-load_dotenv()  # Looks for .env in current working directory (project root)
-
-# Initialize Groq client
-client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
-# Prompt file and schema subset (for basic validation)
-PROMPT_FILE = "prompts/v1_features.md"
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
 
-# Simple schema check (we'll do light validation here; full JSON Schema later)
-REQUIRED_KEYS = ["modules", "features_by_module"]
-
-def load_prompt():
-    with open(PROMPT_FILE, "r", encoding="utf-8") as f:
-        return f.read()
-
-def extract_features(requirements_text):
-    prompt_template = load_prompt()
-    full_prompt = prompt_template.replace("{requirements_text}", requirements_text.strip())
+# Load environment variables from .env at project root
+load_dotenv()
+
+STAGES = ["features", "stories", "api_db", "save"]
+OUTPUT_DIR = os.path.join("outputs", "regression")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["replay", "record", "live"], default="replay")
+    parser.add_argument("--mock", action="store_true", help="use the mock LLM backend instead of Groq")
+    parser.add_argument("--cassette", default=os.path.join("outputs", "cassettes", "samples.jsonl"))
+    parser.add_argument("--samples", default="samples", help="folder with *.txt requirement samples")
+    parser.add_argument("--workers", type=int, default=max(4, os.cpu_count() or 1))
+    parser.add_argument("--baseline", default=os.path.join(OUTPUT_DIR, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs baseline (0.25 = 25%%)")
+    return parser.parse_args()
+
+
+# === Worker process ===
+def init_worker(env: dict, scratch_dir: str):
+    # Every worker gets its own spec store and LLM cache so runs never see each other's state
+    os.environ.update(env)
+    workdir = tempfile.mkdtemp(dir=scratch_dir)
+    os.environ["SPEC_STORE_PATH"] = os.path.join(workdir, "specs.sqlite3")
+    os.environ["LLM_CACHE_PATH"] = os.path.join(workdir, "llm_cache.sqlite3")
+
+
+def run_sample(sample_file: str) -> dict:
+    import io
+    import asyncio
+    import contextlib
+
+    with open(sample_file, "r", encoding="utf-8") as f:
+        requirements_text = f.read()
+
+    marks = {}
+    outcome = {"valid": None, "error": None}
+
+    async def on_event(event, data):
+        marks[event] = time.perf_counter()
+        if event == "complete":
+            outcome["valid"] = data["valid"]
+        elif event == "error":
+            outcome["error"] = f"{data['stage']}: {data['detail']}"
+
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        from app import pipeline  # imported here so the backend is built from this worker's env
+        start = time.perf_counter()
+        try:
+            spec, trace_id = asyncio.run(pipeline.run_pipeline(requirements_text, use_cache=False, on_event=on_event))
+        except Exception as e:
+            spec, outcome["error"] = None, f"{type(e).__name__}: {e}"
+    total = time.perf_counter() - start
+
+    # Stage latency = time between consecutive stage events
+    stages, previous = {}, marks.get("started", start)
+    for stage, event in zip(STAGES, ["features", "stories", "api_db", "complete"]):
+        if event not in marks:
+            break
+        stages[stage] = round(marks[event] - previous, 3)
+        previous = marks[event]
+
+    return {
+        "sample": os.path.basename(sample_file),
+        "success": spec is not None,
+        "valid": outcome["valid"],
+        "error": outcome["error"],
+        "total_seconds": round(total, 3),
+        "stages": stages,
+        "log_tail": log.getvalue().strip().splitlines()[-5:] if spec is None else []
+    }
+
+
+# === Baseline comparison ===
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    problems = []
+    for r in results:
+        before = baseline.get(r["sample"])
+        if before is None:
+            continue
+        if before["success"] and not r["success"]:
+            problems.append(f"{r['sample']}: now FAILS ({r['error']})")
+        elif before.get("valid") and r["valid"] is False:
+            problems.append(f"{r['sample']}: spec no longer passes schema validation")
+        if r["success"] and before["success"] and before["total_seconds"] > 0:
+            slowdown = r["total_seconds"] / before["total_seconds"] - 1
+            if slowdown > tolerance:
+                problems.append(f"{r['sample']}: {slowdown:.0%} slower ({before['total_seconds']}s -> {r['total_seconds']}s)")
+    return problems
+
+
+def worker_env(args) -> dict:
+    env = {"LLM_BACKEND": "mock" if args.mock else "groq"}
+    if args.mock:
+        env["MOCK_LLM_LATENCY"] = os.getenv("MOCK_LLM_LATENCY", "fixed:0")
+    if args.mode != "live":
+        env["LLM_CASSETTE"] = os.path.abspath(args.cassette)
+        env["LLM_CASSETTE_MODE"] = args.mode
+    return env
 
-    try:
-        completion = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",  # Recommended stable model; change if you prefer another
-            # You can also try: "llama3-70b-8192", "llama3-8b-8192", etc.
-            messages=[
-                {
-                    "role": "user",
-                    "content": full_prompt
-                }
-            ],
-            temperature=0.0,        # Deterministic for extraction
-            max_tokens=1000,
-            top_p=1,
-            stream=False            # We'll use non-streaming for simplicity
-        )
-
-        raw_output = completion.choices[0].message.content.strip()
-
-        # Clean common markdown wrappers
-        if raw_output.startswith("```json"):
-            raw_output = raw_output[7:]
-        if raw_output.startswith("```"):
-            raw_output = raw_output[3:]
-        if raw_output.endswith("```"):
-            raw_output = raw_output[:-3]
-        raw_output = raw_output.strip()
-
-        # Parse JSON
-        data = json.loads(raw_output)
-
-        # Basic structure validation
-        for key in REQUIRED_KEYS:
-            if key not in data:
-                raise ValueError(f"Missing required key: {key}")
-
-        if not isinstance(data["modules"], list):
-            raise ValueError("modules must be a list")
-        if not isinstance(data["features_by_module"], dict):
-            raise ValueError("features_by_module must be a dict")
-
-        return data, True, None
-
-    except json.JSONDecodeError as e:
-        return raw_output, False, f"JSON parsing error: {str(e)}"
-    except Exception as e:
-        return raw_output if 'raw_output' in locals() else "", False, f"Error: {str(e)}"
 
 # === Test Harness ===
 if __name__ == "__main__":
-    samples_dir = "samples"
-    output_dir = "outputs/day9"
-    os.makedirs(output_dir, exist_ok=True)
-
-    sample_files = glob.glob(os.path.join(samples_dir, "*.txt"))
+    args = parse_args()
+    sample_files = sorted(glob.glob(os.path.join(args.samples, "*.txt")))
     if not sample_files:
-        print("No samples found in samples/ folder. Add some .txt files first.")
-        exit(1)
+        print(f"No samples found in {args.samples}/ folder. Add some .txt files first.")
+        sys.exit(1)
+    if args.mode == "replay" and not os.path.exists(args.cassette):
+        print(f"No cassette at {args.cassette}. Record one first with --mode record.")
+        sys.exit(1)
+    if args.mode == "record" and os.path.exists(args.cassette):
+        os.remove(args.cassette)  # a fresh recording replaces the old one
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix="spec_regression_")
+    workers = max(1, min(args.workers, len(sample_files)))
+    print(f"Found {len(sample_files)} samples. Running with {workers} workers ({args.mode}"
+          f"{', mock backend' if args.mock else ''})...\n")
 
     results = []
-    print(f"Found {len(sample_files)} samples. Starting extraction...\n")
-
-    for sample_file in sample_files:
-        filename = os.path.basename(sample_file)
-        print(f"Processing {filename}...")
-
-        with open(sample_file, "r", encoding="utf-8") as f:
-            requirements_text = f.read()
-
-        extracted_data, success, error = extract_features(requirements_text)
-
-        result = {
-            "sample": filename,
-            "success": success,
-            "error": error,
-            "output": extracted_data if success else None,
-            "raw_output": extracted_data if not success else None  # Save raw on failure
-        }
-        results.append(result)
-
-        status = "SUCCESS" if success else "FAILED"
-        print(f"  -> {status}")
-        if not success:
-            print(f"     Reason: {error}\n")
+    started = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(worker_env(args), scratch_dir)) as pool:
+            futures = [pool.submit(run_sample, path) for path in sample_files]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                status = "SUCCESS" if result["success"] else "FAILED"
+                stages = "  ".join(f"{k} {v:.2f}s" for k, v in result["stages"].items())
+                print(f"  {result['sample']:<16} {status:<8} {result['total_seconds']:>7.2f}s   {stages}")
+                if not result["success"]:
+                    print(f"     Reason: {result['error']}")
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    wall = time.perf_counter() - started
+    results.sort(key=lambda r: r["sample"])
 
     # Save full results
-    results_path = os.path.join(output_dir, "results.json")
+    results_path = os.path.join(OUTPUT_DIR, "results.json")
     with open(results_path, "w", encoding="utf-8") as f:
-        json.dump(results, f, indent=2, ensure_ascii=False)
+        json.dump({"mode": args.mode, "mock": args.mock, "wall_seconds": round(wall, 3), "results": results},
+                  f, indent=2, ensure_ascii=False)
+
+    problems = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = {r["sample"]: r for r in json.load(f)["results"]}
+        problems = compare(results, baseline, args.tolerance)
+    if args.save_baseline:
+        shutil.copyfile(results_path, args.baseline)
 
     # Summary
     successful = sum(1 for r in results if r["success"])
-    print("\n" + "="*50)
-    print(f"TEST HARNESS COMPLETE")
-    print(f"Successful: {successful}/{len(results)}")
+    print("\n" + "=" * 50)
+    print("REGRESSION RUN COMPLETE")
+    print(f"Successful: {successful}/{len(results)} in {wall:.2f}s")
     print(f"Results saved to: {results_path}")
-    print("="*50)
-
-    if successful == len(results):
-        print("Day 9 extraction step is reliable! Ready for Day 10.")
\ No newline at end of file
+    if args.save_baseline:
+        print(f"Baseline updated: {args.baseline}")
+    elif problems:
+        print(f"Regressions vs baseline ({len(problems)}):")
+        for problem in problems:
+            print(f"  - {problem}")
+    elif os.path.exists(args.baseline):
+        print("No regressions vs baseline.")
+    print("=" * 50)
+
+    sys.exit(1 if problems or successful < len(results) else 0)